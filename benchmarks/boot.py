@@ -0,0 +1,53 @@
+"""Boot time benchmark: default against the fast boot profile.
+
+Builds both profiles first (not measured), then boots the VM several
+times per profile and reports time from createXML to the guest reporting
+that the application started, plus the time to sshd.
+
+    python3 -m benchmarks.boot PACKAGE [--runs 5]
+"""
+import argparse
+import statistics
+
+from vixos.appvm import AppVM
+from vixos.libvirt_utils import libvirt_connection
+from vixos.readiness import Phase
+
+
+def boot_once(conn, package: str, fast_boot: bool) -> tuple[float, float]:
+    appvm = AppVM(package)
+    appvm.fast_boot = fast_boot
+    appvm.make_nix_config_file(package)
+    appvm.generate_vm()
+
+    appvm.start(conn, False, package)
+    try:
+        if not appvm.wait_for_app(120):
+            raise RuntimeError("application didn't start")
+        created = next(
+            appvm.tracer.origin + event["start"]
+            for event in appvm.tracer.to_json()["events"]
+            if event["name"] == "create-domain"
+        )
+        timestamps = appvm.readiness.timestamps
+        return (timestamps[Phase.SSHD] - created, timestamps[Phase.APP] - created)
+    finally:
+        appvm.destroy(conn)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("package")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with libvirt_connection("qemu:///system") as conn:
+        for name, fast_boot in [("default", False), ("fast", True)]:
+            results = [boot_once(conn, args.package, fast_boot) for _ in range(args.runs)]
+            sshd = statistics.median(r[0] for r in results)
+            app = statistics.median(r[1] for r in results)
+            print(f"{name}: sshd after {sshd:.2f}s, app started after {app:.2f}s (median)")
+
+
+if __name__ == "__main__":
+    main()
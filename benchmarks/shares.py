@@ -0,0 +1,88 @@
+"""Compare 9p and virtiofs (and optionally DAX) for the built-in shares.
+
+For every variant the VM is built first (not measured), then booted and
+timed until the guest reports that the application started. After that
+sequential read throughput from /nix/store and write throughput to the
+home directory are measured with dd inside the guest.
+
+    python3 -m benchmarks.shares PACKAGE [--runs 3] [--dax]
+
+--dax adds a virtiofs variant with a DAX window, which needs a QEMU built
+with the out-of-tree virtio-fs DAX patches.
+"""
+import argparse
+import statistics
+import time
+
+from vixos.appvm import AppVM
+from vixos.libvirt_utils import libvirt_connection
+from vixos.readiness import Phase
+from vixos.shares import DEFAULT_SHARES
+
+VARIANTS = {
+    "9p": {"mode": "9p"},
+    "virtiofs": {"mode": "virtiofs"},
+}
+
+DAX_VARIANT = {"mode": "virtiofs", "dax_window": 2048}
+
+# Prints the throughput line of dd (the last line of its stderr).
+READ_STORE = (
+    "f=$(find /nix/store -maxdepth 3 -name '*.so*' -size +20M | head -n 1); "
+    "dd if=$f of=/dev/null bs=1M 2>&1 | tail -n 1"
+)
+WRITE_HOME = (
+    "dd if=/dev/zero of=/home/user/.vixos-bench bs=1M count=256 conv=fsync 2>&1 "
+    "| tail -n 1; rm -f /home/user/.vixos-bench"
+)
+
+
+def remote_output(appvm: AppVM, dom, command: str) -> str:
+    ip = appvm.wait_for_sshd(dom, 30)
+    _, stdout, _ = appvm.ssh.ssh_session("user", ip).exec_command(command)
+    return stdout.read().decode().strip()
+
+
+def run_variant(conn, package: str, shares: dict) -> tuple[float, str, str]:
+    appvm = AppVM(package)
+    appvm.shares = dict(DEFAULT_SHARES, **shares)
+    # Build outside of the measurement.
+    appvm.make_nix_config_file(package)
+    appvm.generate_vm()
+
+    start = time.monotonic()
+    appvm.start(conn, False, package)
+    try:
+        dom = conn.lookupByName(appvm.vm_name)
+        if not appvm.wait_for_app(120):
+            raise RuntimeError("application didn't start")
+        cold_start = appvm.readiness.timestamps[Phase.APP] - start
+        read = remote_output(appvm, dom, READ_STORE)
+        write = remote_output(appvm, dom, WRITE_HOME)
+    finally:
+        appvm.destroy(conn)
+    return cold_start, read, write
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("package")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--dax", action="store_true")
+    args = parser.parse_args()
+
+    variants = dict(VARIANTS)
+    if args.dax:
+        variants["virtiofs+dax"] = DAX_VARIANT
+    with libvirt_connection("qemu:///system") as conn:
+        for name, shares in variants.items():
+            results = [run_variant(conn, args.package, shares) for _ in range(args.runs)]
+            median = statistics.median(cold for cold, _, _ in results)
+            _, read, write = results[-1]
+            print(f"{name}: app started after {median:.2f}s (median)")
+            print(f"  /nix/store read: {read}")
+            print(f"  home write:      {write}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""CLI cold-start benchmark.
+
+Runs `python -m vixos <subcommand> --help` several times per subcommand
+and fails (exit code 1) when the median exceeds its budget, or when an
+import of the CLI executes libvirt, paramiko or pycryptodome.
+
+    python3 benchmarks/startup.py [--runs 10] [--scale 1.0]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold-start budget per subcommand, in milliseconds.
+BUDGETS_MS = {
+    "": 150,
+    "run": 150,
+    "list": 150,
+    "ksm": 150,
+    "ps": 150,
+    "top": 150,
+    "exporter": 150,
+    "shell": 150,
+    "exec": 150,
+    "add": 150,
+    "waypipe-exec": 150,
+    "copy": 150,
+    "mount": 150,
+    "pause": 150,
+    "resume": 150,
+    "pool": 150,
+    "balloon": 150,
+    "reap": 150,
+    "daemon": 150,
+    "jobs": 150,
+    "wait": 150,
+    "cancel": 150,
+}
+
+# Modules that are only executed after a lazy import is actually used.
+HEAVY_MODULES = ["libvirtmod", "paramiko.transport", "Crypto.Math.Numbers"]
+
+CHECK_HEAVY = """
+import sys
+import vixos.cli
+loaded = [name for name in {modules!r} if name in sys.modules]
+print(",".join(loaded))
+"""
+
+
+def measure(subcommand: str, runs: int) -> float:
+    args = [sys.executable, "-m", "vixos"] + ([subcommand] if subcommand else [])
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args + ["--help"], check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiply budgets (slow machines)"
+    )
+    args = parser.parse_args()
+
+    failed = False
+    check = CHECK_HEAVY.format(modules=HEAVY_MODULES)
+    loaded = subprocess.check_output([sys.executable, "-c", check], text=True).strip()
+    if loaded:
+        print(f"FAIL: importing vixos.cli loads {loaded}")
+        failed = True
+
+    for subcommand, budget in BUDGETS_MS.items():
+        median = measure(subcommand, args.runs)
+        limit = budget * args.scale
+        status = "ok" if median <= limit else "FAIL"
+        failed = failed or median > limit
+        name = subcommand or "(main)"
+        print(f"{status:4} {name:<8} {median:7.1f}ms (budget {limit:.0f}ms)")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
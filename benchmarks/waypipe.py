@@ -0,0 +1,79 @@
+"""Frame latency and throughput of waypipe GUI forwarding settings.
+
+Needs a running VM and a Wayland session on the host. weston and
+wayland-utils are added to the VM (see `vixos add`), then for every
+combination of transport, compression and threads:
+
+- latency: median wall time of `wayland-info` (connection setup plus a
+  few protocol round trips) over --runs runs,
+- throughput: frames per second reported by weston-simple-egl.
+
+    python3 -m benchmarks.waypipe PACKAGE [--runs 5] [--transport vsock] ...
+"""
+import argparse
+import itertools
+import re
+import statistics
+import subprocess
+import time
+
+from vixos.appvm import AppVM
+from vixos.libvirt_utils import libvirt_connection
+from vixos.waypipe import TRANSPORTS, WaypipeOptions
+
+ADDED = "/run/vixos/added/bin"
+
+# weston-simple-egl prints "<n> frames in 5 seconds: <fps> fps" periodically.
+FPS = re.compile(r"frames in [\d.]+ seconds: ([\d.]+) fps")
+
+
+def latency(conn, appvm: AppVM, options: WaypipeOptions, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        args = appvm.waypipe_args(conn, f"{ADDED}/wayland-info", options)
+        start = time.monotonic()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.monotonic() - start)
+    return statistics.median(times)
+
+
+def throughput(conn, appvm: AppVM, options: WaypipeOptions, seconds: int) -> float:
+    command = f"timeout {seconds + 1} {ADDED}/weston-simple-egl"
+    args = appvm.waypipe_args(conn, command, options)
+    result = subprocess.run(args, capture_output=True, text=True)
+    fps = [float(match) for match in FPS.findall(result.stdout + result.stderr)]
+    return statistics.mean(fps) if fps else 0.0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("package")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seconds", type=int, default=10)
+    parser.add_argument("--transport", action="append", choices=TRANSPORTS)
+    parser.add_argument("--compress", action="append")
+    parser.add_argument("--threads", action="append", type=int)
+    args = parser.parse_args()
+
+    appvm = AppVM(args.package)
+    with libvirt_connection("qemu:///system") as conn:
+        appvm.add_packages(conn, ["weston", "wayland-utils"])
+        print(f"{'TRANSPORT':<10} {'COMPRESS':<9} {'THREADS':>7} {'LATENCY':>9} {'FPS':>7}")
+        for transport, compress, threads in itertools.product(
+            args.transport or list(TRANSPORTS),
+            args.compress or ["none", "lz4", "zstd"],
+            args.threads or [1, 0],
+        ):
+            options = WaypipeOptions(transport, compress, threads)
+            # The first run after a settings change restarts the client.
+            latency(conn, appvm, options, 1)
+            median = latency(conn, appvm, options, args.runs)
+            fps = throughput(conn, appvm, options, args.seconds)
+            print(
+                f"{transport:<10} {compress:<9} {threads:>7} "
+                f"{median * 1000:>7.0f}ms {fps:>7.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import base64
+import json
+import shutil
+import socket
+import time
+from typing import IO, Any, Optional
+
+from .guest_agent import PORT
+from .lazy import lazy_import
+from .ssh import ExecResult, OutputCallback
+
+pkcs1_15 = lazy_import("Crypto.Signature.pkcs1_15")
+SHA256 = lazy_import("Crypto.Hash.SHA256")
+
+
+class AgentStat:
+    def __init__(self, mode: int, size: int, mtime: float) -> None:
+        self.st_mode = mode
+        self.st_size = size
+        self.st_mtime = mtime
+
+
+class AgentWriter:
+    """File being written in the VM, content is streamed until close()."""
+
+    def __init__(self, sock: socket.socket, reader: IO[bytes]) -> None:
+        self.sock = sock
+        self.reader = reader
+
+    def write(self, data: bytes) -> int:
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self) -> None:
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+            AgentClient.response(self.reader)
+        finally:
+            self.reader.close()
+            self.sock.close()
+
+    def __enter__(self) -> "AgentWriter":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+class AgentClient:
+    """Client of the vixos guest agent (guest_agent.py) over virtio-vsock.
+
+    Every request uses a new connection, which is cheap on vsock and lets
+    threads share one client. Requests are signed with key, the private
+    vixos key whose public part the guest trusts.
+    """
+
+    def __init__(self, cid: int, key, connect_timeout: float = 2.0) -> None:
+        self.cid = cid
+        self.key = key
+        self.connect_timeout = connect_timeout
+
+    def request(self, method: str, **params: Any) -> tuple[socket.socket, IO[bytes]]:
+        sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.connect_timeout)
+            sock.connect((self.cid, PORT))
+            reader = sock.makefile("rb")
+        except OSError:
+            sock.close()
+            raise
+        try:
+            line = reader.readline()
+            if not line:
+                raise RuntimeError("vixos agent closed the connection")
+            sock.settimeout(None)
+            nonce = bytes.fromhex(json.loads(line)["nonce"])
+            signature = pkcs1_15.new(self.key).sign(SHA256.new(nonce))
+            request = {
+                "method": method,
+                "params": params,
+                "signature": base64.b64encode(signature).decode(),
+            }
+            sock.sendall(json.dumps(request).encode() + b"\n")
+        except Exception:
+            reader.close()
+            sock.close()
+            raise
+        return sock, reader
+
+    @staticmethod
+    def response(reader: IO[bytes]) -> Any:
+        line = reader.readline()
+        if not line:
+            raise RuntimeError("vixos agent closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def call(self, method: str, **params: Any) -> Any:
+        sock, reader = self.request(method, **params)
+        with sock, reader:
+            return self.response(reader)
+
+    def ping(self) -> bool:
+        try:
+            return self.call("ping") == "pong"
+        except (OSError, RuntimeError):
+            return False
+
+    def wait(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.ping():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def exec(
+        self,
+        command: str,
+        user: str = "user",
+        timeout: Optional[float] = None,
+        on_output: Optional[OutputCallback] = None,
+        capture: bool = True,
+    ) -> ExecResult:
+        start = time.monotonic()
+        output: dict[str, list[bytes]] = {"stdout": [], "stderr": []}
+        sock, reader = self.request("exec", command=command, user=user, timeout=timeout)
+        with sock, reader:
+            while True:
+                line = reader.readline()
+                if not line:
+                    raise RuntimeError("vixos agent closed the connection")
+                message = json.loads(line)
+                if "stream" not in message:
+                    break
+                data = base64.b64decode(message["data"])
+                if on_output is not None:
+                    on_output(message["stream"], data)
+                if capture:
+                    output[message["stream"]].append(data)
+        if "error" in message:
+            raise RuntimeError(message["error"])
+        return ExecResult(
+            message["result"]["exit_code"],
+            b"".join(output["stdout"]),
+            b"".join(output["stderr"]),
+            message["result"]["timed_out"],
+            time.monotonic() - start,
+        )
+
+    def stat(self, path: str, user: str = "user") -> Optional[AgentStat]:
+        result = self.call("stat", path=path, user=user)
+        return AgentStat(**result) if result is not None else None
+
+    def listdir(self, path: str, user: str = "user") -> list[str]:
+        return self.call("listdir", path=path, user=user)
+
+    def makedirs(self, path: str, user: str = "user") -> None:
+        self.call("makedirs", path=path, user=user)
+
+    def mount(self, mounts: list[dict[str, Any]]) -> None:
+        """Mount virtiofs tags, given as {"tag", "path", "readonly"} dicts."""
+        self.call("mount", mounts=mounts)
+
+    def open_read(self, path: str, offset: int = 0, user: str = "user") -> IO[bytes]:
+        sock, reader = self.request("read", path=path, offset=offset, user=user)
+        # The reader keeps the connection open until it is closed.
+        sock.close()
+        try:
+            self.response(reader)
+        except Exception:
+            reader.close()
+            raise
+        return reader
+
+    def open_write(
+        self, path: str, append: bool = False, user: str = "user"
+    ) -> AgentWriter:
+        sock, reader = self.request("write", path=path, append=append, user=user)
+        try:
+            self.response(reader)
+        except Exception:
+            reader.close()
+            sock.close()
+            raise
+        return AgentWriter(sock, reader)
+
+    def get(self, remote_path: str, local_path: str, user: str = "user") -> None:
+        with self.open_read(remote_path, user=user) as src:
+            with open(local_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def put(self, local_path: str, remote_path: str, user: str = "user") -> None:
+        with open(local_path, "rb") as src:
+            with self.open_write(remote_path, user=user) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
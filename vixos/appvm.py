@@ -1,22 +1,54 @@
 import re
 import os
+import json
+import fcntl
+import hashlib
 import subprocess
-import libvirt
 import time
 import random
 import string
-import subprocess
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from xml.dom import minidom
 from pathlib import Path
-from .template_xml import generate_xml, generate_mount_xml
+from .template_xml import generate_xml, generate_tuning_xml
 from .template_nix import (
     generate_managed_nix,
     generate_default_nix,
     generate_local_nix,
     generate_global_nix,
+    generate_overlay_nix,
+    generate_base_default_nix,
+    generate_added_nix,
 )
-from typing import Tuple, Optional
-from .ssh import SshManager
+from typing import Callable, Iterator, Tuple, Optional
+from .lazy import lazy_import
+from .agent import AgentClient
+from .ssh import ExecResult, OutputCallback, SshManager, print_output
+from .balloon import MIB
+from .build_cache import BuildCache
+from .governor import VM_MEMORY, GovernorConfig, admit
+from .ksm import KsmTuner
+from .pool import WarmPool
+from .mounts import MountInventory, MountSpec
+from .shares import SharesConfig
+from .placement import DEFAULT_VCPUS, Placement, PlacementScheduler, format_cpulist
+from .transfer import AgentEndpoint, Endpoint, RemoteEndpoint
+from .tracing import Tracer
+from .readiness import Phase, ReadinessMonitor, wait_for_port
+from .waypipe import WaypipeClient, WaypipeOptions
+
+libvirt = lazy_import("libvirt")
+
+PLACEMENT_LOCK = threading.Lock()
+
+# Attribute paths accepted by `vixos add`, like `ripgrep` or `python3Packages.ipython`.
+PACKAGE_ATTR = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.+-]*$")
+
+# Hostname of the shared base system, the real one is set at boot.
+BASE_HOSTNAME = "vixos"
 
 
 def random_name() -> str:
@@ -33,10 +65,37 @@ class AppVM:
         # TODO: maybe move non-pure init actions to another functions?
         self.vixos_path.mkdir(exist_ok=True, parents=True)
         self.shared_path.mkdir(exist_ok=True)
-        self.ssh = SshManager(self.vixos_root)
+        self.tracer = Tracer()
+        self.ssh = SshManager(self.vixos_root, self.tracer)
+        self.build_cache = BuildCache(self.vixos_path)
+        self.shares = SharesConfig(self.vixos_root / "shares.json").for_package(name)
+        # Boot profile, see fast_boot_nix in template_nix.py.
+        self.fast_boot = False
+        # Mergeable guest memory for KSM, see generate_memory_backing_xml.
+        self.dedup = False
+        # Set by make_nix_config_file when the app boots the shared base
+        # system, with its package delivered as an overlay profile.
+        self.base_path: Optional[Path] = None
+        self.profile_path: Optional[Path] = None
+        self.readiness: Optional[ReadinessMonitor] = None
+        self.build_process: Optional[subprocess.Popen] = None
+        # Guest agents that answered, by domain UUID.
+        self.agents: dict[str, AgentClient] = {}
+
+    @property
+    def claimed_path(self) -> Path:
+        return self.vixos_path / "domain"
+
+    @property
+    def paused_on_exit_path(self) -> Path:
+        # Written when a run session paused the VM instead of destroying it.
+        return self.vixos_path / "paused-on-exit"
 
     @property
     def vm_name(self) -> str:
+        # VMs claimed from the warm pool keep their pool domain name.
+        if self.claimed_path.exists():
+            return self.claimed_path.read_text().strip()
         return f"vixos_{self.name}"
 
     def try_get_ip_address(self, dom) -> Optional[str]:
@@ -59,29 +118,92 @@ class AppVM:
             return None
         return ipv4_addrs[0]
 
-    def get_ip_address(self, dom, retries: int = 25) -> str:
-        for _ in range(retries):
+    def get_ip_address(self, dom, timeout: float = 25.0) -> str:
+        # The fallback only gets what is left of the timeout.
+        deadline = time.monotonic() + timeout
+        readiness = self.readiness
+        if readiness is not None and readiness.wait(Phase.IP, timeout):
+            if readiness.ip:
+                return readiness.ip
+
+        # Fallback for domains without a readiness channel.
+        while True:
             addr = self.try_get_ip_address(dom)
             if addr is not None:
+                self.tracer.mark("ip-acquired")
                 return addr
-            time.sleep(1)
-        raise ValueError(f"Couldn't get ip address in {retries} tries.")
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+        raise ValueError(f"Couldn't get ip address in {timeout} seconds.")
+
+    def wait_for_sshd(self, dom, timeout: float = 25.0) -> str:
+        deadline = time.monotonic() + timeout
+        ip = self.get_ip_address(dom, timeout)
+        remaining = max(deadline - time.monotonic(), 0)
+        readiness = self.readiness
+        if readiness is not None and readiness.wait(Phase.SSHD, remaining):
+            return ip
+        if not wait_for_port(ip, 22, remaining):
+            raise ValueError(f"sshd is not reachable on {ip}.")
+        self.tracer.mark("sshd-ready")
+        return ip
+
+    def wait_for_app(self, timeout: float = 60.0) -> bool:
+        if self.readiness is None:
+            return False
+        return self.readiness.wait(Phase.APP, timeout)
+
+    def vm_shares(self) -> dict:
+        # virtiofs needs shared guest memory, which KSM can't merge.
+        if self.dedup and self.shares["mode"] == "virtiofs":
+            return dict(self.shares, mode="9p")
+        return self.shares
 
     def xml_config(
-        self, vm_path: Path, is_gui: bool, reginfo: str, image_path: Path
+        self,
+        vm_path: Path,
+        is_gui: bool,
+        reginfo: str,
+        image_path: Path,
+        vm_name: Optional[str] = None,
+        extra_cmdline: str = "",
+        placement: Optional[Placement] = None,
+        memory: int = VM_MEMORY,
     ) -> str:
+        tuning = ""
+        if placement is not None:
+            tuning = generate_tuning_xml(
+                [str(cpu) for cpu in placement.vcpu_pins],
+                format_cpulist(placement.emulator_pin) if placement.emulator_pin else None,
+                str(placement.node) if placement.node is not None else None,
+                placement.strict,
+            )
         return generate_xml(
-            vm_name=self.vm_name,
+            vm_name=vm_name or self.vm_name,
             gui=is_gui,
             vm_path=vm_path,
             reginfo=reginfo,
             image_path=image_path,
             shared_path=self.shared_path,
+            console_log=self.console_log,
+            extra_cmdline=extra_cmdline,
+            vcpus=placement.vcpus if placement is not None else DEFAULT_VCPUS,
+            tuning=tuning,
+            hugepages=placement is not None and placement.hugepages,
+            shares=self.vm_shares(),
+            fast_boot=self.fast_boot,
+            memory=memory // MIB,
+            dedup=self.dedup,
         )
 
     def make_nix_config_file(self, executable: str) -> None:
         managed_config = self.vixos_path / "managed.nix"
-        managed_config.write_text(generate_managed_nix(self.name, self.ssh.pubkey_text))
+        managed_config.write_text(
+            generate_managed_nix(
+                self.name, self.ssh.pubkey_text, self.vm_shares(), self.fast_boot
+            )
+        )
 
         globalf = self.vixos_root / "global.nix"
         if not globalf.exists():
@@ -92,14 +214,84 @@ class AppVM:
             localf.write_text(generate_local_nix())
 
         configpath = self.vixos_path / "default.nix"
+        config = generate_default_nix(self.name, executable)
         if not configpath.exists():
-            config = generate_default_nix(self.name, executable)
             configpath.write_text(config)
 
-    def generate_vm(self) -> Tuple[Path, str, Path]:
-        subprocess.check_call(
+        overlayf = self.vixos_path / "overlay.nix"
+        if not overlayf.exists():
+            overlayf.write_text(generate_overlay_nix(self.name, executable))
+
+        # Apps customised in local.nix or default.nix (or with a default.nix
+        # from older vixos versions) need a system of their own.
+        self.base_path = None
+        if localf.read_text().strip() != generate_local_nix():
+            return
+        if configpath.read_text() != config:
+            print(
+                f"{configpath} differs from the generated one, building a system "
+                "of its own (readiness needs its app to touch /run/vixos/app-started)"
+            )
+            return
+        self.make_base_config()
+
+    def make_base_config(self) -> None:
+        """Write the shared base system, one per distinct managed.nix."""
+        managed = generate_managed_nix(
+            BASE_HOSTNAME, self.ssh.pubkey_text, self.vm_shares(), self.fast_boot, True
+        )
+        default = generate_base_default_nix()
+        variant = hashlib.sha256((managed + default).encode()).hexdigest()[:16]
+        self.base_path = self.vixos_root / ".base" / variant
+        self.base_path.mkdir(exist_ok=True, parents=True)
+        for name, text in [("managed.nix", managed), ("default.nix", default)]:
+            path = self.base_path / name
+            if not path.exists() or path.read_text() != text:
+                path.write_text(text)
+
+    @property
+    def base_cache(self) -> BuildCache:
+        assert self.base_path is not None
+        return BuildCache(
+            self.base_path,
+            [
+                self.base_path / "default.nix",
+                self.base_path / "managed.nix",
+                self.vixos_root / "global.nix",
+            ],
+        )
+
+    @property
+    def overlay_cache(self) -> BuildCache:
+        return BuildCache(
+            self.vixos_path, [self.vixos_path / "overlay.nix"], "overlays"
+        )
+
+    @contextmanager
+    def base_locked(self) -> Iterator[None]:
+        # Several AppVMs (threads or processes) may share one base system.
+        assert self.base_path is not None
+        with open(self.base_path / "build.lock", "w") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def nix_build(self, args: list[str], out_link: Path) -> None:
+        out_link.parent.mkdir(exist_ok=True, parents=True)
+        cmd = ["nix-build", *args, "--out-link", str(out_link)]
+        # Kept around so a build can be cancelled from another thread.
+        self.build_process = subprocess.Popen(cmd)
+        try:
+            if self.build_process.wait() != 0:
+                raise subprocess.CalledProcessError(self.build_process.returncode, cmd)
+        finally:
+            self.build_process = None
+
+    def build_system(self, key: str) -> Tuple[Path, str]:
+        self.nix_build(
             [
-                "nix-build",
                 "<nixpkgs/nixos>",
                 "-A",
                 "config.system.build.vm",
@@ -107,16 +299,93 @@ class AppVM:
                 f"nixos-config={self.vixos_path}/default.nix",
                 "-I",
                 str(self.vixos_path),
-            ]
+            ],
+            self.build_cache.out_link(key),
+        )
+        return self.read_build(key)
+
+    def build_base(self, key: str) -> Tuple[Path, str]:
+        assert self.base_path is not None
+        self.nix_build(
+            [
+                "<nixpkgs/nixos>",
+                "-A",
+                "config.system.build.vm",
+                "-I",
+                f"nixos-config={self.base_path}/default.nix",
+            ],
+            self.base_cache.out_link(key),
         )
+        return self.read_base(key)
 
-        with open(f"result/bin/run-{self.name}-vm", "r") as configf:
+    def build_overlay(self, key: str) -> Tuple[Path, str]:
+        self.nix_build(
+            [str(self.vixos_path / "overlay.nix")], self.overlay_cache.out_link(key)
+        )
+        return self.read_overlay(key)
+
+    def read_build(
+        self,
+        key: str,
+        cache: Optional[BuildCache] = None,
+        hostname: Optional[str] = None,
+    ) -> Tuple[Path, str]:
+        out_link = (cache or self.build_cache).out_link(key)
+        with open(out_link / "bin" / f"run-{hostname or self.name}-vm", "r") as configf:
             config = configf.read()
 
         reginfo = re.findall("regInfo=.*/registration", config)[0]
 
-        realpath = Path(os.readlink("result/system"))
-        os.unlink("result")
+        # The out-link stays in place and acts as a GC root for the build.
+        realpath = Path(os.readlink(out_link / "system"))
+        return (realpath, reginfo)
+
+    def read_base(self, key: str) -> Tuple[Path, str]:
+        return self.read_build(key, self.base_cache, BASE_HOSTNAME)
+
+    def read_overlay(self, key: str) -> Tuple[Path, str]:
+        # Overlays have no regInfo, the base system registers the store.
+        return (self.overlay_cache.out_link(key).resolve(), "")
+
+    def invalidate_builds(self) -> None:
+        self.build_cache.invalidate()
+        self.overlay_cache.invalidate()
+        if self.base_path is not None:
+            self.base_cache.invalidate()
+
+    @staticmethod
+    def cached_build(
+        cache: BuildCache, build: Callable[[str], Tuple[Path, str]]
+    ) -> Tuple[Tuple[Path, str], bool]:
+        key = cache.key()
+        cached = cache.lookup(key)
+        if cached is not None:
+            return cached, True
+        result = build(key)
+        cache.store(key, *result)
+        return result, False
+
+    def generate_vm(self, rebuild: bool = False) -> Tuple[Path, str, Path]:
+        if rebuild:
+            self.invalidate_builds()
+
+        with self.tracer.phase("build") as event:
+            if self.base_path is None:
+                self.profile_path = None
+                (realpath, reginfo), cached = self.cached_build(
+                    self.build_cache, self.build_system
+                )
+            else:
+                # Only the package is built for a new app, the system is shared.
+                with self.base_locked():
+                    (realpath, reginfo), base_cached = self.cached_build(
+                        self.base_cache, self.build_base
+                    )
+                (self.profile_path, _), cached = self.cached_build(
+                    self.overlay_cache, self.build_overlay
+                )
+                event["base_cached"] = base_cached
+            event["cached"] = cached
 
         # TODO: find a way to share the rootfs more cleanly
         qcow2 = self.vixos_path / f"{self.name}.qcow2"
@@ -124,21 +393,65 @@ class AppVM:
             # This file is tiny on disk, because it's sparse.
             # And because of copy-on-write and --snapshot it never grows. The 4096M
             # here is basically just a restriction on maximum non-persistent data size.
-            subprocess.check_call(["qemu-img", "create", "-f", "qcow2", qcow2, "4096M"])
+            with self.tracer.phase("qemu-img"):
+                subprocess.check_call(
+                    ["qemu-img", "create", "-f", "qcow2", qcow2, "4096M"]
+                )
 
         return (realpath, reginfo, qcow2)
 
     def ssh_attach_user(self, dom, wait: bool) -> None:
-        retries = 20 if wait else 1
-        ip = self.get_ip_address(dom, retries)
+        timeout = 20.0 if wait else 0.0
+        with self.tracer.phase("wait-sshd"):
+            ip = self.wait_for_sshd(dom, timeout)
         self.ssh.interactive_session("user", ip)
 
-    def ssh_shell_exec_as_root(self, dom, command: str) -> None:
-        ip = self.get_ip_address(dom, 1)
-        session = self.ssh.ssh_session("root", ip)
-        # TODO: better error handling?
-        session.exec_command(command)
-        session.close()
+    def agent(self, dom, timeout: float = 0.0) -> Optional[AgentClient]:
+        """The guest agent of the VM, or None if it doesn't answer (use ssh).
+
+        Once it answered, the client is reused for the domain.
+        """
+        uuid = dom.UUIDString()
+        agent = self.agents.get(uuid)
+        if agent is not None:
+            return agent
+        cid = self.vsock_cid(dom)
+        if cid is None:
+            return None
+        agent = AgentClient(cid, self.ssh.privkey)
+        if not agent.wait(timeout):
+            return None
+        self.agents = {uuid: agent}
+        return agent
+
+    def ssh_shell_exec_as_root(self, dom, command: str, timeout: float = 0.0) -> None:
+        agent = self.agent(dom, timeout)
+        if agent is not None:
+            result = agent.exec(command, "root")
+        else:
+            ip = self.wait_for_sshd(dom, timeout)
+            result = self.ssh.exec("root", ip, command)
+        if not result.ok:
+            raise subprocess.CalledProcessError(
+                result.exit_code or -1, command, result.stdout, result.stderr
+            )
+
+    def exec(
+        self,
+        conn,
+        command: str,
+        user: str = "user",
+        timeout: Optional[float] = None,
+        on_output: Optional[OutputCallback] = None,
+        capture: bool = True,
+    ) -> ExecResult:
+        """Run a shell command in the running VM and wait for its exit code."""
+        dom = conn.lookupByName(self.vm_name)
+        agent = self.agent(dom)
+        if agent is not None:
+            return agent.exec(command, user, timeout, on_output, capture)
+        ip = self.get_ip_address(dom, 0)
+        return self.ssh.exec(user, ip, command, timeout, on_output, capture)
 
     # TODO extremely ugly, refactor later (duplicated with get_ip_address)s
     def get_ip_address_from_conn(self, conn) -> str:
@@ -148,6 +461,10 @@ class AppVM:
         return ip
 
     def get(self, conn, vm_path: str, local_path: str) -> None:
+        agent = self.agent(conn.lookupByName(self.vm_name))
+        if agent is not None:
+            agent.get(vm_path, local_path)
+            return
         self.ssh.get_from_remote(
             "user",
             self.get_ip_address_from_conn(conn),
@@ -156,6 +473,10 @@ class AppVM:
         )
 
     def put(self, conn, local_path: str, vm_path: str) -> None:
+        agent = self.agent(conn.lookupByName(self.vm_name))
+        if agent is not None:
+            agent.put(local_path, vm_path)
+            return
         self.ssh.put_in_remote(
             "user",
             self.get_ip_address_from_conn(conn),
@@ -163,64 +484,433 @@ class AppVM:
             vm_path,
         )
 
-    def start(self, conn, is_gui: bool, executable: str) -> None:
-        self.make_nix_config_file(executable)
-        vm_path, reginfo, qcow2 = self.generate_vm()
-        config = self.xml_config(vm_path, is_gui, reginfo, qcow2)
-        dom = conn.createXML(config)
+    def boot(
+        self,
+        conn,
+        is_gui: bool,
+        executable: str,
+        rebuild: bool = False,
+        vm_name: Optional[str] = None,
+        extra_cmdline: str = "",
+        admission: Optional[str] = None,
+    ):
+        """Build and create the domain, once the admission policy allows it.
+
+        admission overrides the configured admission action.
+        """
+        with self.tracer.phase("nix-config"):
+            self.make_nix_config_file(executable)
+        vm_path, reginfo, qcow2 = self.generate_vm(rebuild)
+        if self.profile_path is not None:
+            extra_cmdline += (
+                f" vixos.profile={self.profile_path} vixos.hostname={self.name}"
+            )
+        # May queue for minutes, so it doesn't hold the placement lock.
+        # Launches admitted concurrently are accounted for by admit().
+        with self.tracer.phase("admission"):
+            policy = GovernorConfig(self.vixos_root / "governor.json")
+            memory = admit(policy.admission_policy(), self.name, admission)
+        # Placement must see domains booted concurrently by other threads.
+        with PLACEMENT_LOCK:
+            with self.tracer.phase("placement"):
+                scheduler = PlacementScheduler(conn, self.vixos_root / "placement.json")
+                placement = scheduler.place(self.name, vm_name or self.vm_name)
+            config = self.xml_config(
+                vm_path,
+                is_gui,
+                reginfo,
+                qcow2,
+                vm_name,
+                extra_cmdline,
+                placement,
+                memory,
+            )
+            with self.tracer.phase("create-domain"):
+                dom = conn.createXML(config)
         if not dom:
             raise SystemExit("Failed to create a domain from an XML definition")
-        print(f"Guest {dom.name()} has booted")
+        if self.dedup:
+            KsmTuner(self.vixos_root).update(conn, True)
+        return dom
+
+    @property
+    def added_path(self) -> Path:
+        return self.vixos_path / "added"
 
-    def waypipe_exec(self, conn, command: str) -> None:
+    def add_packages(self, conn, packages: list[str], timeout: float = 10.0) -> Path:
+        """Build packages on the host and link them into the running VM.
+
+        The VM sees new store paths through its /nix/store share, so only
+        a symlink changes in the guest. Packages added earlier to the same
+        domain are kept, the list is reset when the domain changes.
+        """
+        for package in packages:
+            if not PACKAGE_ATTR.match(package):
+                raise ValueError(f"Invalid package name: {package}")
         dom = conn.lookupByName(self.vm_name)
-        ip = self.get_ip_address(dom, 1)
 
-        name = random_name()
-        socket_name = f"/tmp/{name}"
+        state_path = self.vixos_path / "added.json"
+        state = {"domain": dom.UUIDString(), "packages": []}
+        if state_path.exists():
+            previous = json.loads(state_path.read_text())
+            if previous["domain"] == state["domain"]:
+                state = previous
+        for package in packages:
+            if package not in state["packages"]:
+                state["packages"].append(package)
+
+        with self.tracer.phase("build-added"):
+            self.nix_build(
+                ["-E", generate_added_nix(state["packages"])], self.added_path
+            )
+        store_path = self.added_path.resolve()
+        state_path.write_text(json.dumps(state))
+
+        with self.tracer.phase("link-added"):
+            # Shares may cache lookups for a moment, wait for the new path.
+            self.ssh_shell_exec_as_root(
+                dom,
+                f"""
+                for i in $(seq {int(timeout * 10)}); do
+                    [ -e {store_path} ] && break
+                    sleep 0.1
+                done
+                ln -sfn {store_path} /run/vixos/added.tmp
+                mv -T /run/vixos/added.tmp /run/vixos/added
+                """,
+            )
+        return store_path
+
+    def inject_args(self, dom, args: str) -> None:
+        # Pool domains wait for this file before starting the application.
+        self.ssh_shell_exec_as_root(
+            dom,
+            f"""
+            printf '%s' {shlex.quote(args)} > /run/vixos/args.tmp
+            chown user /run/vixos/args.tmp
+            mv /run/vixos/args.tmp /run/vixos/args
+            """,
+            timeout=25.0,
+        )
+
+    def endpoint(self, conn, compress: bool = False) -> Endpoint:
+        agent = self.agent(conn.lookupByName(self.vm_name))
+        if agent is not None:
+            # vsock is not worth compressing.
+            return AgentEndpoint(agent, self.name, "user")
+        return RemoteEndpoint(
+            self.ssh,
+            self.name,
+            "user",
+            self.get_ip_address_from_conn(conn),
+            compress,
+        )
 
-        client = subprocess.Popen(["waypipe", "--socket", socket_name, "client"])
-        command = f"waypipe --socket {socket_name} server -- {command}"
-        flags = ["-R", f"{socket_name}:{socket_name}", command]
-        self.ssh.interactive_session("user", ip, flags)
-        client.kill()
+    def start(
+        self,
+        conn,
+        is_gui: bool,
+        executable: str,
+        rebuild: bool = False,
+        pool: Optional[WarmPool] = None,
+        args: str = "",
+    ) -> None:
+        self.claimed_path.unlink(missing_ok=True)
+        self.paused_on_exit_path.unlink(missing_ok=True)
+        if pool is not None and not rebuild:
+            with self.tracer.phase("pool-claim"):
+                dom = pool.claim(
+                    conn, self.name, is_gui, executable, self.fast_boot, self.dedup
+                )
+            if dom is not None:
+                self.claimed_path.write_text(dom.name())
+                self.readiness = ReadinessMonitor.attach(conn, dom)
+                with self.tracer.phase("inject-args"):
+                    self.inject_args(dom, args)
+                print(f"Guest {dom.name()} claimed from the warm pool")
+                return
+
+        (self.shared_path / ".args").write_text(args)
+        dom = self.boot(conn, is_gui, executable, rebuild)
+        self.readiness = ReadinessMonitor.attach(conn, dom)
+        print(f"Guest {dom.name()} has booted")
 
-    def attach(self, conn, is_gui: bool) -> None:
-        if is_gui:
-            subprocess.check_call(["virt-viewer", "-c", conn.getURI(), self.vm_name])
+    def pause(self, conn, on_exit: bool = False) -> None:
+        """Suspend the VM in memory, it keeps its memory but uses no CPU.
+
+        on_exit says a run session with --pause-on-exit ended, resuming the
+        VM then starts such a session again. Saving to disk isn't offered:
+        QEMU can't save domains with 9p shares, and qemu-vm.nix mounts its
+        xchg and shared 9p shares in every guest.
+        """
+        conn.lookupByName(self.vm_name).suspend()
+        if on_exit:
+            self.paused_on_exit_path.touch()
         else:
+            self.paused_on_exit_path.unlink(missing_ok=True)
+
+    def resume(self, conn):
+        """Resume the VM suspended in memory."""
+        try:
             dom = conn.lookupByName(self.vm_name)
-            self.ssh_attach_user(dom, True)
+        except libvirt.libvirtError:
+            raise SystemExit(f"{self.name} is not running, use vixos run")
+        if dom.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
+            dom.resume()
+        return dom
+
+    def vsock_cid(self, dom) -> Optional[int]:
+        """CID of the domain, saved per domain UUID like the mount inventory."""
+        uuid = dom.UUIDString()
+        state_path = self.vixos_path / "vsock.json"
+        if state_path.exists():
+            state = json.loads(state_path.read_text())
+            if state["domain"] == uuid:
+                return state["cid"]
+        cid = self.read_vsock_cid(dom)
+        state_path.write_text(json.dumps({"domain": uuid, "cid": cid}))
+        return cid
+
+    @staticmethod
+    def read_vsock_cid(dom) -> Optional[int]:
+        xml = minidom.parseString(dom.XMLDesc())
+        for vsock in xml.getElementsByTagName("vsock"):
+            for cid in vsock.getElementsByTagName("cid"):
+                if cid.hasAttribute("address"):
+                    return int(cid.getAttribute("address"))
+        return None
+
+    def waypipe_args(
+        self, conn, command: str, options: Optional[WaypipeOptions] = None
+    ) -> list[str]:
+        """ssh command line running command under waypipe in the VM.
+
+        Makes sure the persistent waypipe client of this VM is running.
+        """
+        dom = conn.lookupByName(self.vm_name)
+        ip = self.get_ip_address(dom, 0)
+        options = options or WaypipeOptions()
+        cid = None
+        if options.transport == "vsock":
+            cid = self.vsock_cid(dom)
+            if cid is None:
+                print("Domain has no vsock device, using the ssh transport")
+                options.transport = "ssh"
+
+        client = WaypipeClient(self.vixos_path, options, cid)
+        client.ensure()
+        return self.ssh.ssh_args("user", ip, client.ssh_command(command))
+
+    def waypipe_exec(
+        self, conn, command: str, options: Optional[WaypipeOptions] = None
+    ) -> None:
+        options = options or WaypipeOptions()
+        agent = self.agent(conn.lookupByName(self.vm_name))
+        if agent is None or options.transport != "vsock":
+            subprocess.check_call(self.waypipe_args(conn, command, options))
+            return
+
+        # Entirely over vsock: the agent starts the server, which connects
+        # to the client directly.
+        client = WaypipeClient(self.vixos_path, options, agent.cid)
+        client.ensure()
+        server_command = client.server_command(command, "")
+        result = agent.exec(server_command, on_output=print_output, capture=False)
+        if not result.ok:
+            raise subprocess.CalledProcessError(result.exit_code or -1, server_command)
+
+    def attach(self, conn, is_gui: bool) -> None:
+        with self.tracer.phase("attach", gui=is_gui):
+            if is_gui:
+                subprocess.check_call(
+                    ["virt-viewer", "-c", conn.getURI(), self.vm_name]
+                )
+            else:
+                dom = conn.lookupByName(self.vm_name)
+                self.ssh_attach_user(dom, True)
+
+    @property
+    def console_log(self) -> Path:
+        return self.vixos_path / "console.log"
+
+    def new_trace(self) -> None:
+        """Start a new trace, for AppVMs reused across launches (vixosd)."""
+        self.tracer = Tracer()
+        self.ssh.tracer = self.tracer
+
+    def save_trace(self, keep: int = 20) -> Path:
+        """Add guest boot phases to the trace and write it as json."""
+        if self.readiness is not None:
+            for phase, timestamp in self.readiness.timestamps.items():
+                self.tracer.mark(f"guest-{phase.value}", timestamp)
+
+        traces = self.vixos_path / "traces"
+        path = traces / time.strftime("%Y%m%d-%H%M%S.json")
+        self.tracer.save(path)
+        for old in sorted(traces.glob("*.json"))[:-keep]:
+            old.unlink()
+        return path
 
     def destroy(self, conn):
+        ip = None
         try:
             dom = conn.lookupByName(self.vm_name)
+            ip = self.try_get_ip_address(dom)
             print(f"Destroying {dom.name()}")
             dom.destroy()
         except libvirt.libvirtError:
             print(f"Destroying failed (probably domain already destroyed).")
-
-    def has_filesystem(self, conn, mount_tag) -> bool:
-        dom = conn.lookupByName(self.vm_name)
-        xml = dom.XMLDesc()
-        dom = minidom.parseString(xml)
-        for diskType in dom.getElementsByTagName("filesystem"):
-            target_obj = diskType.getElementsByTagName("target")[0]
-            target_dir = target_obj.attributes["dir"].value
-            if target_dir == mount_tag:
-                return True
-        return False
-
-    def attach_filesystem(self, conn, source: str, mount_tag: str) -> None:
-        dom = conn.lookupByName(self.vm_name)
-        mount_xml = generate_mount_xml(source, mount_tag)
-        dom.attachDevice(mount_xml)
-
-    def mount_filesystem(self, conn, mount_tag: str, destination: str) -> None:
-        dom = conn.lookupByName(self.vm_name)
-        # TODO: refactor by escaping the shell (ideally abstract over this)
-        cmd = f"""
-            mkdir -p {destination}
-            mount -t virtiofs {mount_tag} {destination}
+        if ip is not None:
+            self.ssh.close_host(ip)
+        self.claimed_path.unlink(missing_ok=True)
+        self.paused_on_exit_path.unlink(missing_ok=True)
+        WaypipeClient(self.vixos_path, WaypipeOptions()).stop()
+        KsmTuner(self.vixos_root).update(conn)
+
+    def cancel_build(self) -> None:
+        process = self.build_process
+        if process is not None:
+            process.terminate()
+
+    def mount_inventory(self, dom) -> MountInventory:
+        return MountInventory(dom, self.vixos_path / "mounts.json")
+
+    def mount(
+        self,
+        conn,
+        specs: list[MountSpec],
+        inventory: Optional[MountInventory] = None,
+    ) -> list[MountSpec]:
+        """Attach and mount host directories in one pass.
+
+        Returns the specs that weren't attached before. Mounting is
+        idempotent, directories already mounted in the guest are skipped.
         """
-        self.ssh_shell_exec_as_root(dom, cmd)
+        dom = conn.lookupByName(self.vm_name)
+        inventory = inventory or self.mount_inventory(dom)
+        attached = inventory.attach(specs)
+
+        agent = self.agent(dom)
+        if agent is not None:
+            agent.mount(
+                [
+                    {"tag": s.tag, "path": s.destination, "readonly": s.readonly}
+                    for s in specs
+                ]
+            )
+            return attached
+        commands = []
+        for spec in specs:
+            path = shlex.quote(spec.destination)
+            options = "-o ro " if spec.readonly else ""
+            commands.append(
+                f"mkdir -p {path} && (mountpoint -q {path} || "
+                f"mount -t virtiofs {options}{spec.tag} {path})"
+            )
+        self.ssh_shell_exec_as_root(dom, " && ".join(commands))
+        return attached
+
+
+def exec_many(
+    conn,
+    appvms: list[AppVM],
+    command: str,
+    user: str = "user",
+    timeout: Optional[float] = None,
+    jobs: int = 8,
+    on_output: Optional[Callable[[AppVM, str, bytes], None]] = None,
+    capture: bool = True,
+) -> dict[str, ExecResult]:
+    """Run command in many VMs, at most `jobs` at a time.
+
+    Returns a result for every AppVM, keyed by name. Failures to reach a
+    VM are reported in the result instead of being raised.
+    """
+
+    def run(appvm: AppVM) -> ExecResult:
+        callback = None
+        if on_output is not None:
+            callback = lambda stream, data: on_output(appvm, stream, data)
+        start = time.monotonic()
+        try:
+            return appvm.exec(conn, command, user, timeout, callback, capture)
+        except Exception as e:
+            return ExecResult(None, duration=time.monotonic() - start, error=str(e))
+
+    with ThreadPoolExecutor(max_workers=max(min(jobs, len(appvms)), 1)) as executor:
+        results = list(executor.map(run, appvms))
+    return {appvm.name: result for appvm, result in zip(appvms, results)}
+
+
+def build_vms(appvms: list[AppVM], rebuild: bool = False) -> None:
+    """Build the VMs of many AppVMs with a single nix-build invocation.
+
+    Cached builds are skipped, and a base system shared by several AppVMs
+    is built once. Each build gets its own out-link (GC root) in its build
+    cache, so later generate_vm calls are hits.
+    """
+    pending = []
+    bases: set[Path] = set()
+    for appvm in appvms:
+        if rebuild:
+            appvm.invalidate_builds()
+        if appvm.base_path is None:
+            default_nix = appvm.vixos_path / "default.nix"
+            targets = [(appvm.build_cache, f"build {default_nix}", appvm.read_build)]
+        else:
+            overlay_nix = appvm.vixos_path / "overlay.nix"
+            targets = [
+                (appvm.overlay_cache, f"import {overlay_nix}", appvm.read_overlay)
+            ]
+            if appvm.base_path not in bases:
+                bases.add(appvm.base_path)
+                base_nix = appvm.base_path / "default.nix"
+                targets.append((appvm.base_cache, f"build {base_nix}", appvm.read_base))
+        for cache, expr, read in targets:
+            key = cache.key()
+            if cache.lookup(key) is None:
+                pending.append((cache, key, expr, read))
+    if not pending:
+        return
+
+    attrs = "\n".join(
+        f"  vm{i} = {expr};" for i, (_, _, expr, _) in enumerate(pending)
+    )
+    expr = f"""
+let
+  build = configuration:
+    (import <nixpkgs/nixos> {{ inherit configuration; }}).config.system.build.vm;
+in builtins.mapAttrs (name: drv: drv.drvPath) {{
+{attrs}
+}}"""
+    # Derivations by attribute name: several attributes may evaluate to
+    # the same derivation, so output order can't be relied upon.
+    drvs = json.loads(
+        subprocess.check_output(
+            [
+                "nix-instantiate",
+                "--read-write-mode",
+                "--eval",
+                "--strict",
+                "--json",
+                "-E",
+                expr,
+            ],
+            text=True,
+        )
+    )
+    # One realisation, so the builds run in parallel.
+    subprocess.check_call(
+        ["nix-store", "--realise", *sorted(set(drvs.values()))],
+        stdout=subprocess.DEVNULL,
+    )
+
+    for i, (cache, key, _, read) in enumerate(pending):
+        out_link = cache.out_link(key)
+        out_link.parent.mkdir(exist_ok=True, parents=True)
+        # Register the out-link as a GC root, like nix-build --out-link does.
+        subprocess.check_call(
+            ["nix-store", "--add-root", str(out_link), "--realise", drvs[f"vm{i}"]],
+            stdout=subprocess.DEVNULL,
+        )
+        cache.store(key, *read(key))
@@ -0,0 +1,130 @@
+import json
+import time
+from pathlib import Path
+from typing import Any, Iterator, Optional
+from .lazy import lazy_import
+
+libvirt = lazy_import("libvirt")
+
+# How often the guest balloon driver refreshes memory statistics, seconds.
+STATS_PERIOD = 2
+
+MIB = 1024  # libvirt reports memory in KiB
+
+
+def host_meminfo() -> dict[str, int]:
+    """Parse /proc/meminfo into KiB values."""
+    result = {}
+    for line in Path("/proc/meminfo").read_text().splitlines():
+        name, _, value = line.partition(":")
+        result[name] = int(value.split()[0])
+    return result
+
+
+class BalloonPolicy:
+    """Decides guest memory sizes, all values are in KiB.
+
+    The goal is to keep `target_free` of the guest memory unused. Guests
+    never go below `floor` or above `ceiling` (or their maximum memory),
+    and never grow while the host has less than `host_reserve` available.
+    """
+
+    def __init__(
+        self,
+        floor: int = 512 * MIB,
+        ceiling: Optional[int] = None,
+        target_free: float = 0.25,
+        host_reserve: int = 1024 * MIB,
+        hysteresis: int = 64 * MIB,
+    ) -> None:
+        self.floor = floor
+        self.ceiling = ceiling
+        self.target_free = target_free
+        self.host_reserve = host_reserve
+        self.hysteresis = hysteresis
+
+    def decide(
+        self, stats: dict[str, int], max_memory: int, host_available: int
+    ) -> tuple[int, str]:
+        actual = stats["actual"]
+        free = stats.get("usable", stats.get("unused"))
+        if free is None:
+            return actual, "no guest statistics yet"
+
+        used = actual - free
+        target = int(used / (1 - self.target_free))
+        ceiling = min(self.ceiling or max_memory, max_memory)
+        target = max(self.floor, min(target, ceiling))
+
+        under_pressure = host_available < self.host_reserve
+        if target > actual and under_pressure:
+            return actual, "host under memory pressure, not growing"
+        if abs(target - actual) < self.hysteresis:
+            return actual, "within hysteresis"
+        if under_pressure:
+            return target, "shrink (host under memory pressure)"
+        return target, "grow" if target > actual else "shrink"
+
+
+class BalloonController:
+    """Periodically resizes the balloon of every running vixos domain."""
+
+    def __init__(self, conn, policy: BalloonPolicy, state_path: Path) -> None:
+        self.conn = conn
+        self.policy = policy
+        self.state_path = state_path
+        self.configured: set[str] = set()
+
+    def domains(self) -> list:
+        domains = self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        return [dom for dom in domains if dom.name().startswith("vixos_")]
+
+    def ensure_stats_period(self, dom) -> None:
+        if dom.name() in self.configured:
+            return
+        try:
+            dom.setMemoryStatsPeriod(STATS_PERIOD, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+        except libvirt.libvirtError:
+            pass
+        self.configured.add(dom.name())
+
+    def step(self, dry_run: bool = False) -> list[dict[str, Any]]:
+        host_available = host_meminfo()["MemAvailable"]
+        decisions = []
+        for dom in self.domains():
+            self.ensure_stats_period(dom)
+            try:
+                stats = dom.memoryStats()
+                max_memory = dom.maxMemory()
+            except libvirt.libvirtError:
+                continue  # Domain went away in the meantime.
+
+            target, reason = self.policy.decide(stats, max_memory, host_available)
+            applied = False
+            if target != stats["actual"] and not dry_run:
+                dom.setMemoryFlags(target, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+                applied = True
+                # Count the change against the host before deciding the next VM.
+                host_available -= target - stats["actual"]
+            decisions.append(
+                {
+                    "domain": dom.name(),
+                    "actual": stats["actual"],
+                    "usable": stats.get("usable", stats.get("unused")),
+                    "target": target,
+                    "reason": reason,
+                    "applied": applied,
+                }
+            )
+
+        self.state_path.write_text(
+            json.dumps({"time": time.time(), "decisions": decisions}, indent=2)
+        )
+        return decisions
+
+    def run(
+        self, interval: float, dry_run: bool = False
+    ) -> Iterator[list[dict[str, Any]]]:
+        while True:
+            yield self.step(dry_run)
+            time.sleep(interval)
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Optional, Tuple
+
+
+def nixpkgs_revision() -> str:
+    """Identify the nixpkgs used by `<nixpkgs/nixos>` without evaluating Nix.
+
+    Channels are symlinks into the store, so the resolved path changes on
+    every channel update. This is much cheaper than asking nix for a version.
+    """
+    candidates = []
+    for entry in os.environ.get("NIX_PATH", "").split(":"):
+        if entry.startswith("nixpkgs="):
+            candidates.append(entry[len("nixpkgs=") :])
+    candidates.append(str(Path.home() / ".nix-defexpr" / "channels" / "nixpkgs"))
+    candidates.append("/nix/var/nix/profiles/per-user/root/channels/nixpkgs")
+
+    for candidate in candidates:
+        path = Path(candidate)
+        if path.exists():
+            return str(path.resolve())
+    # Unknown revision (for example a URL in NIX_PATH). Still cacheable,
+    # but use `vixos run --rebuild` after updating nixpkgs.
+    return "unknown"
+
+
+class BuildCache:
+    """Maps a hash of the VM nix configuration to the built system.
+
+    Every entry is a directory with a nix-build out-link (registered by
+    nix as an indirect GC root) and a small json with the system path and
+    regInfo kernel parameter.
+    """
+
+    def __init__(
+        self,
+        vixos_path: Path,
+        files: Optional[list[Path]] = None,
+        name: str = "builds",
+    ) -> None:
+        self.vixos_path = vixos_path
+        self.cache_path = vixos_path / name
+        self.files = files
+
+    def config_files(self) -> list[Path]:
+        if self.files is not None:
+            return self.files
+        return [
+            self.vixos_path / "default.nix",
+            self.vixos_path / "managed.nix",
+            self.vixos_path / "local.nix",
+            self.vixos_path.parent / "global.nix",
+        ]
+
+    def key(self) -> str:
+        digest = hashlib.sha256()
+        for path in self.config_files():
+            digest.update(path.name.encode() + b"\0")
+            digest.update(path.read_bytes() if path.exists() else b"")
+            digest.update(b"\0")
+        digest.update(nixpkgs_revision().encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return self.cache_path / key
+
+    def out_link(self, key: str) -> Path:
+        return self.entry_path(key) / "result"
+
+    def lookup(self, key: str) -> Optional[Tuple[Path, str]]:
+        metadata = self.entry_path(key) / "build.json"
+        if not metadata.exists() or not self.out_link(key).exists():
+            return None
+        data = json.loads(metadata.read_text())
+        realpath = Path(data["system"])
+        if not realpath.exists():
+            return None
+        return (realpath, data["reginfo"])
+
+    def store(self, key: str, realpath: Path, reginfo: str) -> None:
+        metadata = self.entry_path(key) / "build.json"
+        metadata.write_text(json.dumps({"system": str(realpath), "reginfo": reginfo}))
+        # Only the newest build is kept alive, older ones may be collected.
+        for entry in self.cache_path.iterdir():
+            if entry.name != key:
+                shutil.rmtree(entry, ignore_errors=True)
+
+    def invalidate(self) -> None:
+        shutil.rmtree(self.cache_path, ignore_errors=True)
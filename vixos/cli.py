@@ -1,9 +1,21 @@
 import click
 import os
-import tempfile
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-from .appvm import AppVM
-from .libvirt_utils import libvirt_connection
+from .appvm import AppVM, build_vms, exec_many
+from .client import DaemonClient
+from .governor import AdmissionRejected
+from .libvirt_utils import is_gui, libvirt_connection
+from .mounts import CACHE_MODES, MountSpec
+from .pool import WarmPool
+from .shares import DEFAULT_SHARES
+from .ssh import print_output
+from .transfer import Endpoint, LocalEndpoint, TransferEngine
+from .waypipe import WaypipeOptions
 
 
 def parse_file_specification(spec: str) -> tuple[str | None, str]:
@@ -18,13 +30,12 @@ def parse_file_specification(spec: str) -> tuple[str | None, str]:
 
 
 @click.group()
-@click.pass_context
-def main():
+def main() -> None:
     pass
 
 
 @main.command()
-@click.argument("package")
+@click.argument("packages", nargs=-1, required=True)
 @click.option(
     '--gui',
     '-g',
@@ -44,31 +55,168 @@ def main():
     '-e',
     help='Set the executable name to run (by default uses the package name)'
 )
-def run(package: str, gui: bool, background: bool, executable: str | None) -> None:
-    """Run a nixpkgs program
+@click.option(
+    '--rebuild',
+    is_flag=True,
+    default=False,
+    help='If specified, ignore the build cache and rebuild the VM.'
+)
+@click.option(
+    '--trace',
+    is_flag=True,
+    default=False,
+    help='If specified, print a per-phase timing breakdown of the launch.'
+)
+@click.option(
+    '--fast-boot',
+    is_flag=True,
+    default=False,
+    help='If specified, use the fast boot profile (no serial console, slim initrd).'
+)
+@click.option(
+    '--pause-on-exit',
+    is_flag=True,
+    default=False,
+    help='If specified, suspend the VM in memory when the session ends, instead of destroying it.'
+)
+@click.option(
+    '--dedup',
+    is_flag=True,
+    default=False,
+    help='If specified, make guest memory mergeable by KSM (uses 9p shares, see `vixos ksm`).'
+)
+def run(
+    packages: tuple[str, ...],
+    gui: bool,
+    background: bool,
+    executable: str | None,
+    rebuild: bool,
+    trace: bool,
+    fast_boot: bool,
+    pause_on_exit: bool,
+    dedup: bool,
+) -> None:
+    """Run nixpkgs programs
 
-    Starts a VM and executes PACKAGAE (or EXECUTABLE if specified).
+    Starts a VM and executes PACKAGE (or EXECUTABLE if specified). With
+    more than one package, all VMs are built with one nix-build and booted
+    in parallel. The first package is attached to, the others keep running
+    in the background. --pause-on-exit suspends the VM in memory when the
+    session ends, `vixos resume` picks it up again.
 
     Examples:
     vixos run bash
     vixos run --gui firefox
+    vixos run --gui firefox thunderbird keepassxc
     """
+    if executable is not None and len(packages) > 1:
+        raise click.UsageError("--executable can only be used with one package")
+    if len(packages) > 1:
+        run_many(
+            packages, gui, background, rebuild, trace, fast_boot, pause_on_exit, dedup
+        )
+        return
+
+    package = packages[0]
     print(f"OK, running {package}...")
-    appvm = AppVM(package)
     executable = executable or package
 
+    client = DaemonClient.connect() if background else None
+    if client is not None:
+        # Let the daemon build and boot the VM, don't block the terminal.
+        job = client.call(
+            "run",
+            package=package,
+            gui=gui,
+            executable=executable,
+            rebuild=rebuild,
+            fast_boot=fast_boot,
+            dedup=dedup,
+        )
+        print(f"Started job {job['id']}, use `vixos wait {job['id']}` to wait for it")
+        client.close()
+        return
+
+    appvm = AppVM(package)
+    appvm.fast_boot = fast_boot
+    appvm.dedup = dedup
+    pool = WarmPool(appvm.vixos_root)
+
     with libvirt_connection("qemu:///system") as conn:
         try:
-            appvm.start(conn, gui, executable)
+            appvm.start(conn, gui, executable, rebuild, pool)
+        except AdmissionRejected as e:
+            background = True  # Nothing to attach to.
+            raise click.ClickException(str(e))
         finally:
             if not background:
                 appvm.attach(conn, gui)
-                appvm.destroy(conn)
+                stop(conn, appvm, pause_on_exit)
+            trace_path = appvm.save_trace()
+            if trace:
+                print(appvm.tracer.report())
+                print(f"Trace saved to {trace_path}, console log in {appvm.console_log}")
+
+
+def run_many(
+    packages: tuple[str, ...],
+    gui: bool,
+    background: bool,
+    rebuild: bool,
+    trace: bool,
+    fast_boot: bool,
+    pause_on_exit: bool,
+    dedup: bool,
+) -> None:
+    print(f"OK, running {', '.join(packages)}...")
+    appvms = [AppVM(package) for package in packages]
+    pool = WarmPool(appvms[0].vixos_root)
+    for appvm in appvms:
+        appvm.fast_boot = fast_boot
+        appvm.dedup = dedup
+        appvm.make_nix_config_file(appvm.name)
+    build_vms(appvms, rebuild)
+
+    foreground = appvms[0]
+    with libvirt_connection("qemu:///system") as conn:
+        try:
+            with ThreadPoolExecutor(max_workers=len(appvms)) as executor:
+                futures = [
+                    executor.submit(appvm.start, conn, gui, appvm.name, False, pool)
+                    for appvm in appvms
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            if not background:
+                foreground.attach(conn, gui)
+                stop(conn, foreground, pause_on_exit)
+            for appvm in appvms:
+                trace_path = appvm.save_trace()
+                if trace:
+                    print(f"{appvm.name}:")
+                    print(appvm.tracer.report())
+                    print(f"Trace saved to {trace_path}")
+
+
+def stop(conn, appvm: AppVM, pause: bool) -> None:
+    if not pause:
+        appvm.destroy(conn)
+    else:
+        appvm.pause(conn, on_exit=True)
+        print(f"{appvm.name} is suspended, `vixos resume {appvm.name}` resumes it")
 
 
 @main.command(name="list")
 def list_vms() -> None:
     """List available vixos VMs"""
+    client = DaemonClient.connect()
+    if client is not None:
+        for name in client.call("list"):
+            print(name)
+        client.close()
+        return
+
     with libvirt_connection("qemu:///system") as conn:
         domains = conn.listAllDomains()
         if domains is None:
@@ -80,6 +228,73 @@ def list_vms() -> None:
                 print(dom.name())
 
 
+@main.command()
+def ksm() -> None:
+    """Show memory merged by KSM, per VM and in total
+
+    Only VMs started with `vixos run --dedup` have mergeable memory. While
+    they run, the KSM settings of ~/vixos/ksm.json are applied (as root).
+    """
+    from .ksm import collect, format_ksm, host_ksm
+
+    with libvirt_connection("qemu:///system") as conn:
+        print(format_ksm(collect(conn), host_ksm()))
+
+
+@main.command()
+def ps() -> None:
+    """Show resource usage of running VMs"""
+    from .stats import collect, format_ps
+
+    with libvirt_connection("qemu:///system") as conn:
+        print(format_ps(collect(conn)))
+
+
+@main.command()
+@click.option(
+    '--interval',
+    '-n',
+    default=2.0,
+    show_default=True,
+    help='Seconds between refreshes.'
+)
+def top(interval: float) -> None:
+    """Live resource usage of running VMs"""
+    from .stats import collect, format_top, rates
+
+    previous: dict = {}
+    with libvirt_connection("qemu:///system") as conn:
+        while True:
+            current = collect(conn)
+            entries = rates(previous, current)
+            previous = {entry["name"]: entry for entry in current}
+            click.clear()
+            print(format_top(entries))
+            time.sleep(interval)
+
+
+@main.command()
+@click.option(
+    '--listen',
+    default="127.0.0.1:9733",
+    show_default=True,
+    help='Address to serve /metrics on.'
+)
+@click.option(
+    '--cache',
+    default=5.0,
+    show_default=True,
+    help='Seconds to reuse collected stats between scrapes.'
+)
+def exporter(listen: str, cache: float) -> None:
+    """Serve Prometheus metrics for VMs and launch latencies"""
+    from .exporter import Exporter
+
+    host, _, port = listen.rpartition(":")
+    with libvirt_connection("qemu:///system") as conn:
+        Exporter(conn, Path.home() / "vixos", cache).serve(host, int(port))
+
+
 @main.command()
 @click.argument("package")
 def shell(package) -> None:
@@ -90,68 +305,511 @@ def shell(package) -> None:
         appvm.attach(conn, False)
 
 
+class PrefixedOutput:
+    """Writes output of many VMs line by line, prefixed with the VM name."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.partial: dict[tuple[str, str], bytes] = {}
+
+    def write(self, appvm: AppVM, stream: str, data: bytes) -> None:
+        out = sys.stdout.buffer if stream == "stdout" else sys.stderr.buffer
+        with self.lock:
+            key = (appvm.name, stream)
+            *lines, self.partial[key] = (self.partial.get(key, b"") + data).split(b"\n")
+            for line in lines:
+                out.write(f"[{appvm.name}] ".encode() + line + b"\n")
+            out.flush()
+
+    def flush(self) -> None:
+        for (name, stream), rest in self.partial.items():
+            if rest:
+                out = sys.stdout.buffer if stream == "stdout" else sys.stderr.buffer
+                out.write(f"[{name}] ".encode() + rest + b"\n")
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+@main.command(name="exec")
+@click.argument("packages")
+@click.argument("command", nargs=-1, required=True)
+@click.option(
+    '--root',
+    is_flag=True,
+    default=False,
+    help='If specified, run the command as root instead of user.'
+)
+@click.option(
+    '-t',
+    '--timeout',
+    type=float,
+    default=None,
+    help='Give up on the command after this many seconds.'
+)
+@click.option(
+    '-j',
+    '--jobs',
+    type=int,
+    default=8,
+    help='How many VMs run the command at the same time.'
+)
+def exec_command(
+    packages: str,
+    command: tuple[str, ...],
+    root: bool,
+    timeout: float | None,
+    jobs: int,
+) -> None:
+    """Execute a shell command in running VMs.
+
+    PACKAGES is a comma separated list of VMs, or `all` for every running VM.
+    Output is streamed, and the exit code of the command is returned.
+    With many VMs, output lines are prefixed with the VM name and the exit
+    code is 1 if the command failed anywhere. Example:
+
+    vixos exec firefox,chromium -- df -h /
+    """
+    from .stats import running_packages
+
+    with libvirt_connection("qemu:///system") as conn:
+        if packages == "all":
+            names = running_packages(conn)
+        else:
+            names = [name for name in packages.split(",") if name]
+        if not names:
+            raise click.ClickException("No running VMs")
+        appvms = [AppVM(name) for name in names]
+        output = PrefixedOutput() if len(appvms) > 1 else None
+        if output is not None:
+            on_output = output.write
+        else:
+            on_output = lambda appvm, stream, data: print_output(stream, data)
+        results = exec_many(
+            conn,
+            appvms,
+            " ".join(command),
+            "root" if root else "user",
+            timeout,
+            jobs,
+            on_output,
+            capture=False,
+        )
+
+    if output is None:
+        result = results[names[0]]
+        if result.error is not None:
+            click.echo(f"Error: {result.error}", err=True)
+            sys.exit(255)
+        if result.timed_out:
+            click.echo(f"Timed out after {timeout}s", err=True)
+            sys.exit(124)
+        sys.exit(result.exit_code)
+
+    output.flush()
+    for name, result in results.items():
+        if result.error is not None:
+            status = f"error: {result.error}"
+        elif result.timed_out:
+            status = "timed out"
+        else:
+            status = f"exit {result.exit_code}"
+        click.echo(f"{name:<20} {result.duration:>7.2f}s  {status}", err=True)
+    sys.exit(0 if all(result.ok for result in results.values()) else 1)
+
+
 @main.command()
 @click.argument("package")
 @click.argument("command", nargs=-1)
-def waypipe_exec(package: str, command: str) -> None:
+@click.option(
+    '--transport',
+    type=click.Choice(["vsock", "ssh"]),
+    default="vsock",
+    help='Carry Wayland traffic over virtio-vsock (default) or an ssh tunnel.'
+)
+@click.option(
+    '--compress',
+    default="lz4",
+    help='waypipe compression: none, lz4, zstd or zstd=LEVEL.'
+)
+@click.option(
+    '--threads',
+    type=int,
+    default=0,
+    help='waypipe worker threads (0 lets waypipe choose).'
+)
+@click.option(
+    '--video',
+    default=None,
+    help='Encode DMABUF frames as video, waypipe --video value (e.g. hw).'
+)
+def waypipe_exec(
+    package: str,
+    command: str,
+    transport: str,
+    compress: str,
+    threads: int,
+    video: str | None,
+) -> None:
     """Execute shell command using waypipe.
 
     Execute COMMAND inside running VM specified by PACKAGE.
     TO execute multi-argument command use '--'. Example:
 
     vixos waypipe-exec bash -- ls -lha
+
+    A waypipe client per VM is kept running and reused by later commands.
     """
     appvm = AppVM(package)
+    options = WaypipeOptions(transport, compress, threads, video)
 
     with libvirt_connection("qemu:///system") as conn:
-        appvm.waypipe_exec(conn, " ".join(command))
+        appvm.waypipe_exec(conn, " ".join(command), options)
 
 
 @main.command()
 @click.argument("source", type=click.Path())
-@click.argument("destination", type=click.Path())
-def copy(source, destination) -> None:
-    """Copy from/to VMs
+@click.argument("destinations", type=click.Path(), nargs=-1, required=True)
+@click.option(
+    '--jobs',
+    '-j',
+    default=4,
+    show_default=True,
+    help='Number of files transferred concurrently.'
+)
+@click.option(
+    '--compress',
+    '-C',
+    is_flag=True,
+    default=False,
+    help='If specified, compress data on the wire.'
+)
+@click.option(
+    '--resume',
+    is_flag=True,
+    default=False,
+    help='If specified, continue partially transferred files.'
+)
+def copy(
+    source: str, destinations: tuple[str, ...], jobs: int, compress: bool, resume: bool
+) -> None:
+    """Copy files or directories from/to VMs
 
-    SOURCE specification, like `vmname:/etc/passwd` or `mylocalfile`.",
-    DESTINATION specification, like `vmname:/tmp/file` or `mylocalfile`.",
+    SOURCE specification, like `vmname:/etc/passwd` or `mylocalfile`.
+    DESTINATIONS specifications, like `vmname:/tmp/file` or `mylocalfile`.
+    With more than one destination the source is copied to all of them.
     """
     source_vm, source_path = parse_file_specification(source)
-    dest_vm, dest_path = parse_file_specification(destination)
+    dests = [parse_file_specification(dest) for dest in destinations]
+    engine = TransferEngine(jobs, resume)
 
     with libvirt_connection("qemu:///system") as conn:
-        if source_vm is None and dest_vm is None:
+        if source_vm is None and all(dest_vm is None for dest_vm, _ in dests):
             print("Just use `cp`...")
             return
-        if source_vm is not None and dest_vm is not None:
-            source = AppVM(source_vm)
-            dest = AppVM(dest_vm)
-            with tempfile.NamedTemporaryFile() as tempf:
-                source.get(conn, source_path, tempf.name)
-                dest.put(conn, tempf.name, dest_path)
-                return
-        if source_vm is not None:
-            source = AppVM(source_vm)
-            source.get(conn, source_path, dest_path)
-        if dest_vm is not None:
-            dest = AppVM(dest_vm)
-            dest.put(conn, source_path, dest_path)
+
+        def endpoint(vm: str | None) -> Endpoint:
+            if vm is None:
+                return LocalEndpoint()
+            return AppVM(vm).endpoint(conn, compress)
+
+        src = endpoint(source_vm)
+        stats = engine.copy(
+            src, source_path, [(endpoint(vm), path) for vm, path in dests]
+        )
+        print(stats.summary())
 
 
 @main.command()
 @click.argument("package")
-@click.argument("source", default=os.getcwd())
-@click.argument("destination")
-def mount(package: str, source: str, destination: str) -> None:
-    """Mount a directory into a running VM
+@click.argument("specs", nargs=-1)
+@click.option(
+    '--cache',
+    type=click.Choice(CACHE_MODES),
+    default=DEFAULT_SHARES["cache"],
+    help='virtiofsd cache mode.'
+)
+@click.option(
+    '--thread-pool',
+    type=int,
+    default=DEFAULT_SHARES["thread_pool"],
+    help='virtiofsd thread pool size.'
+)
+@click.option(
+    '--readonly',
+    is_flag=True,
+    default=False,
+    help='If specified, mount read-only.'
+)
+@click.option(
+    '--no-xattr',
+    is_flag=True,
+    default=False,
+    help='If specified, disable extended attributes in virtiofsd.'
+)
+def mount(
+    package: str,
+    specs: tuple[str, ...],
+    cache: str,
+    thread_pool: int,
+    readonly: bool,
+    no_xattr: bool,
+) -> None:
+    """Mount host directories into a running VM
+
+    Every SPEC is SOURCE[:DESTINATION[:OPTIONS]], the destination is the
+    source path by default. OPTIONS override the command line options for
+    one mount: ro, rw, noxattr, cache=MODE, threads=N, queue=N. Without
+    SPECS the current working directory is mounted. Example:
 
-    help="Source directory (on the host). Uses current workign directory by default.",
-    help="Destination directory (in the VM). Same as source directory by default.",
+    vixos mount firefox ~/Downloads ~/src:/home/user/src:ro,cache=always
+    """
+    defaults = dict(
+        cache=cache, thread_pool=thread_pool, readonly=readonly, xattr=not no_xattr
+    )
+    try:
+        mounts = [MountSpec.parse(spec, **defaults) for spec in specs or [os.getcwd()]]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    client = DaemonClient.connect()
+    if client is not None:
+        client.call("mount", package=package, mounts=[m.to_json() for m in mounts])
+        client.close()
+    else:
+        with libvirt_connection("qemu:///system") as conn:
+            AppVM(package).mount(conn, mounts)
+    for m in mounts:
+        mode = "ro" if m.readonly else "rw"
+        print(f"{m.source} -> {package}:{m.destination} ({mode})")
+
+
+@main.command()
+@click.argument("package")
+@click.argument("packages", nargs=-1, required=True)
+def add(package: str, packages: tuple[str, ...]) -> None:
+    """Add nixpkgs PACKAGES to the running VM specified by PACKAGE.
+
+    Packages are built on the host and appear in the VM in
+    /run/vixos/added/bin (on PATH of new shells), without a reboot.
     """
     appvm = AppVM(package)
 
+    start = time.monotonic()
     with libvirt_connection("qemu:///system") as conn:
-        mount_name = destination
-        if not appvm.has_filesystem(conn, mount_name):
-            appvm.attach_filesystem(conn, source, mount_name)
-        appvm.mount_filesystem(conn, mount_name, destination)
+        try:
+            store_path = appvm.add_packages(conn, list(packages))
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    elapsed = time.monotonic() - start
+    print(f"Added {', '.join(packages)} to {package} in {elapsed:.1f}s ({store_path})")
+
+
+@main.command()
+@click.argument("package")
+def pause(package: str) -> None:
+    """Pause a running VM
+
+    Suspends PACKAGE in memory, `vixos resume PACKAGE` resumes it. The
+    VM keeps its memory, pausing only stops its CPU use.
+    """
+    appvm = AppVM(package)
+    with libvirt_connection("qemu:///system") as conn:
+        appvm.pause(conn)
+    print(f"{package} is suspended in memory")
+
+
+@main.command()
+@click.argument("package")
+@click.option(
+    '--background',
+    is_flag=True,
+    default=False,
+    help='If specified, do not attach to the VM.'
+)
+def resume(package: str, background: bool) -> None:
+    """Resume a paused VM
+
+    Resumes PACKAGE and attaches to it. A VM paused by `vixos run
+    --pause-on-exit` is paused again when the session ends, others keep
+    running.
+    """
+    appvm = AppVM(package)
+    with libvirt_connection("qemu:///system") as conn:
+        dom = appvm.resume(conn)
+        print(f"Guest {dom.name()} resumed")
+        if not background:
+            on_exit = appvm.paused_on_exit_path.exists()
+            appvm.attach(conn, is_gui(dom))
+            if on_exit:
+                stop(conn, appvm, True)
+
+
+@main.group()
+def pool() -> None:
+    """Manage the warm pool of pre-booted VMs
+
+    Configured in ~/vixos/pool.json, for example:
+    {"max_total": 8, "packages": {"firefox": {"size": 2, "gui": true}}}
+    """
+    pass
+
+
+@pool.command(name="fill")
+@click.argument("packages", nargs=-1)
+def pool_fill(packages: tuple[str, ...]) -> None:
+    """Boot missing pool VMs (for PACKAGES, or all configured packages)"""
+    warm_pool = WarmPool(Path.home() / "vixos")
+    packages = packages or tuple(warm_pool.load_config()["packages"])
+
+    with libvirt_connection("qemu:///system") as conn:
+        for package in packages:
+            started = warm_pool.fill(conn, package)
+            print(f"{package}: started {started} pool VMs")
+
+
+@pool.command(name="stats")
+def pool_stats() -> None:
+    """Show warm pool hit/miss rates and claim latency"""
+    warm_pool = WarmPool(Path.home() / "vixos")
+    for package, entry in warm_pool.load_stats().items():
+        total = entry["hits"] + entry["misses"]
+        latencies = sorted(entry["latencies"])
+        median = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        print(
+            f"{package}: {entry['hits']}/{total} hits, "
+            f"median claim latency {median:.1f}ms"
+        )
+
+
+@main.command()
+@click.option(
+    '--interval',
+    default=5.0,
+    show_default=True,
+    help='Seconds between balloon adjustments.'
+)
+@click.option('--floor', default=512, show_default=True, help='Minimum guest memory (MiB).')
+@click.option('--ceiling', type=int, help='Maximum guest memory (MiB, default: VM maximum).')
+@click.option(
+    '--host-reserve',
+    default=1024,
+    show_default=True,
+    help='Never grow guests while the host has less memory available (MiB).'
+)
+@click.option('--once', is_flag=True, default=False, help='Adjust once and exit.')
+@click.option('--dry-run', is_flag=True, default=False, help='Only print decisions.')
+def balloon(
+    interval: float,
+    floor: int,
+    ceiling: int | None,
+    host_reserve: int,
+    once: bool,
+    dry_run: bool,
+) -> None:
+    """Automatically grow and shrink memory of running VMs
+
+    The latest decisions are also written to ~/vixos/balloon.json.
+    """
+    from .balloon import MIB, BalloonController, BalloonPolicy
+
+    policy = BalloonPolicy(
+        floor=floor * MIB,
+        ceiling=ceiling * MIB if ceiling else None,
+        host_reserve=host_reserve * MIB,
+    )
+    with libvirt_connection("qemu:///system") as conn:
+        controller = BalloonController(conn, policy, Path.home() / "vixos" / "balloon.json")
+        for decisions in controller.run(interval, dry_run):
+            for d in decisions:
+                print(
+                    f"{d['domain']}: {d['actual'] // MIB} -> {d['target'] // MIB} MiB "
+                    f"({d['reason']})"
+                )
+            if once:
+                return
+
+
+@main.command()
+@click.option(
+    '--interval',
+    '-n',
+    default=30.0,
+    show_default=True,
+    help='Seconds between activity samples.'
+)
+@click.option('--once', is_flag=True, default=False, help='Sample twice, act and exit.')
+@click.option('--dry-run', is_flag=True, default=False, help='Only print decisions.')
+def reap(interval: float, once: bool, dry_run: bool) -> None:
+    """Suspend VMs that stay idle
+
+    A VM is idle while its CPU usage and network traffic (which carries
+    ssh and waypipe input) stay below the thresholds in
+    ~/vixos/governor.json. Idle VMs are suspended in memory, which stops
+    their CPU use but doesn't free their memory. The latest decisions are
+    also written to ~/vixos/reaper.json.
+    """
+    from .governor import GovernorConfig, IdleReaper
+
+    vixos_root = Path.home() / "vixos"
+    policy = GovernorConfig(vixos_root / "governor.json").idle_policy()
+    with libvirt_connection("qemu:///system") as conn:
+        reaper = IdleReaper(conn, policy, vixos_root / "reaper.json")
+        for i, decisions in enumerate(reaper.run(interval, dry_run)):
+            for d in decisions:
+                if d["action"] is not None:
+                    print(f"{d['domain']}: idle for {d['idle']:.0f}s, {d['action']}")
+            if once and i > 0:
+                return
+
+
+@main.command()
+@click.option(
+    '--uri',
+    default="qemu:///system",
+    show_default=True,
+    help='Libvirt connection URI.'
+)
+def daemon(uri: str) -> None:
+    """Run vixosd, sharing one libvirt connection between CLI calls"""
+    from .daemon import run_daemon
+
+    run_daemon(uri)
+
+
+def daemon_client() -> DaemonClient:
+    client = DaemonClient.connect()
+    if client is None:
+        raise click.ClickException("vixosd is not running (start it with `vixos daemon`)")
+    return client
+
+
+def print_job(job: dict) -> None:
+    error = f" ({job['error']})" if job["error"] else ""
+    print(f"{job['id']}\t{job['state']}\t{job['description']}{error}")
+
+
+@main.command()
+def jobs() -> None:
+    """List daemon jobs"""
+    client = daemon_client()
+    for job in client.call("jobs"):
+        print_job(job)
+    client.close()
+
+
+@main.command()
+@click.argument("job", type=int)
+def wait(job: int) -> None:
+    """Wait until a daemon job finishes"""
+    client = daemon_client()
+    print_job(client.call("wait", job=job))
+    client.close()
+
+
+@main.command()
+@click.argument("job", type=int)
+def cancel(job: int) -> None:
+    """Cancel a daemon job (and destroy its VM)"""
+    client = daemon_client()
+    print_job(client.call("cancel", job=job))
+    client.close()
@@ -0,0 +1,45 @@
+import json
+import socket
+from pathlib import Path
+from typing import Any, Optional
+
+
+def socket_path() -> Path:
+    return Path.home() / "vixos" / "vixosd.sock"
+
+
+class DaemonClient:
+    """Thin client for the vixosd Unix socket API (see daemon.py)."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    @classmethod
+    def connect(cls, path: Optional[Path] = None) -> Optional["DaemonClient"]:
+        """Connect to a running daemon, or return None if there is none."""
+        path = path or socket_path()
+        if not path.exists():
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(path))
+        except OSError:
+            sock.close()
+            return None
+        return cls(sock)
+
+    def call(self, method: str, **params: Any) -> Any:
+        request = {"method": method, "params": params}
+        self.sock.sendall(json.dumps(request).encode() + b"\n")
+        line = self.reader.readline()
+        if not line:
+            raise RuntimeError("vixosd closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def close(self) -> None:
+        self.reader.close()
+        self.sock.close()
@@ -0,0 +1,225 @@
+import asyncio
+import itertools
+import json
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+
+from .appvm import AppVM
+from .lazy import lazy_import
+from .client import socket_path
+from .mounts import MountInventory, MountSpec
+from .pool import WarmPool
+
+libvirt = lazy_import("libvirt")
+libvirtaio = lazy_import("libvirtaio")
+
+# How long a run job waits for the guest to report the app started, so
+# its trace has the guest boot phases.
+APP_TIMEOUT = 60.0
+
+
+class Job:
+    """A long running operation (build, boot) executed by the daemon."""
+
+    def __init__(self, job_id: int, package: str, description: str) -> None:
+        self.id = job_id
+        self.package = package
+        self.description = description
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.cancel_requested = False
+        self.done = asyncio.Event()
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "package": self.package,
+            "description": self.description,
+            "state": self.state,
+            "error": self.error,
+        }
+
+
+class Daemon:
+    """Holds one libvirt connection, AppVMs (with their SSH pools) and jobs.
+
+    Clients talk to it over a Unix socket with one json object per line:
+    {"method": "run", "params": {...}} is answered with {"result": ...} or
+    {"error": "..."}.
+    """
+
+    def __init__(self, uri: str) -> None:
+        self.conn = libvirt.open(uri)
+        if not self.conn:
+            raise RuntimeError(f"Failed to open connection to {uri}")
+        self.appvms: dict[str, AppVM] = {}
+        self.jobs: dict[int, Job] = {}
+        self.job_ids = itertools.count(1)
+        self.pool = WarmPool(Path.home() / "vixos")
+        # Per domain name, kept current by libvirt device events.
+        self.inventories: dict[str, MountInventory] = {}
+        self.handlers: dict[str, Callable[[dict[str, Any]], Awaitable[Any]]] = {
+            "run": self.handle_run,
+            "list": self.handle_list,
+            "destroy": self.handle_destroy,
+            "jobs": self.handle_jobs,
+            "wait": self.handle_wait,
+            "cancel": self.handle_cancel,
+            "mount": self.handle_mount,
+        }
+
+    def appvm(self, package: str) -> AppVM:
+        if package not in self.appvms:
+            self.appvms[package] = AppVM(package)
+        return self.appvms[package]
+
+    def check_no_job(self, package: str) -> None:
+        for job in self.jobs.values():
+            if job.package == package and not job.done.is_set():
+                raise RuntimeError(f"Job {job.id} is already running for {package}")
+
+    def submit(self, package: str, description: str, func: Callable, *args) -> Job:
+        self.check_no_job(package)
+        job = Job(next(self.job_ids), package, description)
+        self.jobs[job.id] = job
+        asyncio.create_task(self.run_job(job, func, args))
+        return job
+
+    async def run_job(self, job: Job, func: Callable, args: tuple) -> None:
+        job.state = "running"
+        try:
+            await asyncio.to_thread(func, *args)
+            job.state = "done"
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e)
+        if job.cancel_requested:
+            await asyncio.to_thread(self.appvm(job.package).destroy, self.conn)
+            job.state = "cancelled"
+        job.done.set()
+
+    def get_job(self, params: dict[str, Any]) -> Job:
+        job_id = int(params["job"])
+        if job_id not in self.jobs:
+            raise RuntimeError(f"No such job: {job_id}")
+        return self.jobs[job_id]
+
+    async def handle_run(self, params: dict[str, Any]) -> Any:
+        package = params["package"]
+        appvm = self.appvm(package)
+        fast_boot = bool(params.get("fast_boot", False))
+        dedup = bool(params.get("dedup", False))
+
+        def run(*args: Any) -> None:
+            # Set by the job, a rejected duplicate request never touches
+            # the options of a job in progress.
+            appvm.fast_boot = fast_boot
+            appvm.dedup = dedup
+            # One trace per launch, like `vixos run` saves them.
+            appvm.new_trace()
+            try:
+                appvm.start(*args)
+                appvm.wait_for_app(APP_TIMEOUT)
+            finally:
+                appvm.save_trace()
+
+        job = self.submit(
+            package,
+            f"run {package}",
+            run,
+            self.conn,
+            bool(params.get("gui", False)),
+            params.get("executable") or package,
+            bool(params.get("rebuild", False)),
+            self.pool,
+        )
+        return job.to_json()
+
+    async def handle_list(self, params: dict[str, Any]) -> Any:
+        domains = await asyncio.to_thread(self.conn.listAllDomains)
+        return [dom.name() for dom in domains if dom.name().startswith("vixos_")]
+
+    async def handle_destroy(self, params: dict[str, Any]) -> Any:
+        appvm = self.appvm(params["package"])
+        await asyncio.to_thread(appvm.destroy, self.conn)
+
+    async def handle_jobs(self, params: dict[str, Any]) -> Any:
+        return [job.to_json() for job in self.jobs.values()]
+
+    async def handle_wait(self, params: dict[str, Any]) -> Any:
+        job = self.get_job(params)
+        await job.done.wait()
+        return job.to_json()
+
+    async def handle_cancel(self, params: dict[str, Any]) -> Any:
+        job = self.get_job(params)
+        if not job.done.is_set():
+            job.cancel_requested = True
+            self.appvm(job.package).cancel_build()
+        return job.to_json()
+
+    def inventory(self, appvm: AppVM, dom) -> MountInventory:
+        inventory = self.inventories.get(dom.name())
+        if inventory is not None and inventory.uuid == dom.UUIDString():
+            return inventory
+        if inventory is not None:
+            # The domain was restarted since.
+            inventory.deregister_events(self.conn)
+        inventory = appvm.mount_inventory(dom)
+        inventory.register_events(self.conn)
+        self.inventories[dom.name()] = inventory
+        return inventory
+
+    async def handle_mount(self, params: dict[str, Any]) -> Any:
+        appvm = self.appvm(params["package"])
+        specs = [MountSpec(**spec) for spec in params["mounts"]]
+
+        def mount() -> list[MountSpec]:
+            dom = self.conn.lookupByName(appvm.vm_name)
+            return appvm.mount(self.conn, specs, self.inventory(appvm, dom))
+
+        attached = await asyncio.to_thread(mount)
+        return [spec.tag for spec in attached]
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    handler = self.handlers[request["method"]]
+                    response = {"result": await handler(request.get("params", {}))}
+                except Exception as e:
+                    response = {"error": f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, path: Path) -> None:
+        path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self.handle_client, path=str(path))
+        path.chmod(0o600)
+        print(f"vixosd listening on {path}")
+        async with server:
+            await server.serve_forever()
+
+    def close(self) -> None:
+        for appvm in self.appvms.values():
+            appvm.ssh.close_all()
+        self.conn.close()
+
+
+def run_daemon(uri: str) -> None:
+    async def main() -> None:
+        # Dispatches libvirt events (mount inventories) on the asyncio loop,
+        # must be registered before the connection is opened.
+        libvirtaio.virEventRegisterAsyncIOImpl()
+        daemon = Daemon(uri)
+        try:
+            await daemon.serve(socket_path())
+        finally:
+            daemon.close()
+
+    asyncio.run(main())
@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Optional
+
+from .stats import collect
+
+# Launch phase histogram buckets, in seconds.
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+DOMAIN_METRICS = [
+    ("cpu_time", "vixos_domain_cpu_seconds_total", "counter", "CPU time used"),
+    ("memory", "vixos_domain_memory_bytes", "gauge", "Current balloon size"),
+    ("rss", "vixos_domain_rss_bytes", "gauge", "Resident set size of qemu"),
+    ("disk_read", "vixos_domain_disk_read_bytes_total", "counter", "Bytes read"),
+    ("disk_write", "vixos_domain_disk_write_bytes_total", "counter", "Bytes written"),
+    ("net_rx", "vixos_domain_network_receive_bytes_total", "counter", "Bytes received"),
+    ("net_tx", "vixos_domain_network_transmit_bytes_total", "counter", "Bytes sent"),
+]
+
+
+def launch_phases(trace: dict[str, Any]) -> dict[str, float]:
+    """Extract launch phase durations (seconds) from a trace saved by AppVM."""
+    first: dict[str, dict[str, Any]] = {}
+    for event in trace["events"]:
+        first.setdefault(event["name"], event)
+
+    phases = {}
+    if "build" in first:
+        phases["build"] = first["build"]["end"] - first["build"]["start"]
+    create = first.get("create-domain") or first.get("pool-claim")
+    if create is None:
+        return phases
+    phases["boot"] = create["end"] - create["start"]
+    # Guest reported phases are more precise than the host side fallbacks.
+    for phase, names in [
+        ("ip", ["guest-ip", "ip-acquired"]),
+        ("ssh_ready", ["guest-sshd", "sshd-ready"]),
+        ("app", ["guest-app"]),
+    ]:
+        for name in names:
+            if name in first:
+                phases[phase] = first[name]["start"] - create["start"]
+                break
+    return phases
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bucket in enumerate(BUCKETS):
+            if value <= bucket:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Exporter:
+    """Serves domain stats and launch latency histograms in Prometheus format.
+
+    Domain stats come from one bulk libvirt query, cached for `cache_ttl`
+    seconds, so frequent scrapes don't add load on libvirt.
+    """
+
+    def __init__(self, conn, vixos_root: Path, cache_ttl: float) -> None:
+        self.conn = conn
+        self.vixos_root = vixos_root
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.cached: Optional[str] = None
+        self.cached_at = 0.0
+        self.seen_traces: set[Path] = set()
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+
+    def scan_traces(self) -> None:
+        for path in sorted(self.vixos_root.glob("*/traces/*.json")):
+            if path in self.seen_traces:
+                continue
+            self.seen_traces.add(path)
+            package = path.parent.parent.name
+            try:
+                trace = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            for phase, seconds in launch_phases(trace).items():
+                key = (package, phase)
+                self.histograms.setdefault(key, Histogram()).observe(seconds)
+
+    def render(self) -> str:
+        lines = []
+        domains = collect(self.conn)
+        for key, name, kind, help_text in DOMAIN_METRICS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for entry in domains:
+                labels = f'domain="{entry["name"]}",package="{entry["package"]}"'
+                lines.append(f"{name}{{{labels}}} {entry[key]}")
+        lines.append("# HELP vixos_domains Running vixos domains")
+        lines.append("# TYPE vixos_domains gauge")
+        lines.append(f"vixos_domains {len(domains)}")
+
+        self.scan_traces()
+        name = "vixos_launch_phase_seconds"
+        lines.append(f"# HELP {name} Duration of AppVM launch phases")
+        lines.append(f"# TYPE {name} histogram")
+        for (package, phase), histogram in sorted(self.histograms.items()):
+            labels = f'package="{package}",phase="{phase}"'
+            for bucket, count in zip(BUCKETS, histogram.counts):
+                lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def metrics(self) -> str:
+        with self.lock:
+            now = time.monotonic()
+            if self.cached is None or now - self.cached_at > self.cache_ttl:
+                self.cached = self.render()
+                self.cached_at = now
+            return self.cached
+
+    def serve(self, host: str, port: int) -> None:
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+        ThreadingHTTPServer((host, port), Handler).serve_forever()
@@ -0,0 +1,273 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Iterator, Optional
+from .balloon import MIB, host_meminfo
+from .lazy import lazy_import
+from .pool import UNCLAIMED, domain_description
+from .stats import collect, rates
+
+libvirt = lazy_import("libvirt")
+
+IDLE_ACTIONS = ("suspend",)
+ADMISSION_ACTIONS = ("queue", "downsize", "reject")
+
+# Maximum and initial memory of a VM (KiB), see xml_template in template_xml.py.
+VM_MEMORY = 8192 * MIB
+VM_CURRENT_MEMORY = 1024 * MIB
+
+# Idle and admission policies, each governor.json section replaces single
+# keys. Times are in seconds, memory in MiB, cpu in guest CPU seconds per
+# second, net in bytes per second and max_load is the host load average
+# per CPU. The "suspend" idle action only stops the guest's CPU use, its
+# memory stays allocated (see AppVM.pause).
+DEFAULT_GOVERNOR: dict[str, dict[str, Any]] = {
+    "idle": {
+        "after": 900,
+        "cpu": 0.02,
+        "net": 4096,
+        "action": "suspend",
+        "exclude": [],
+    },
+    "admission": {
+        "action": "queue",
+        "host_reserve": 1024,
+        "min_memory": 512,
+        "max_load": 1.5,
+        "queue_timeout": 300,
+    },
+}
+
+# How long a launch counts against the host before its guest shows up in
+# MemAvailable, and the launches admitted by this process in that time.
+SETTLE_TIME = 30.0
+RECENT_LAUNCHES: list[tuple[float, int]] = []
+RECENT_LOCK = threading.Lock()
+
+
+class AdmissionRejected(RuntimeError):
+    pass
+
+
+def host_load() -> float:
+    """1 minute load average per CPU."""
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+class GovernorConfig:
+    """Idle and admission policies, from ~/vixos/governor.json."""
+
+    def __init__(self, config_path: Path) -> None:
+        self.config: dict[str, Any] = {}
+        if config_path.exists():
+            self.config = json.loads(config_path.read_text())
+
+    def section(self, name: str) -> dict[str, Any]:
+        config = dict(DEFAULT_GOVERNOR[name])
+        config.update(self.config.get(name, {}))
+        return config
+
+    def idle_policy(self) -> "IdlePolicy":
+        config = self.section("idle")
+        return IdlePolicy(
+            after=config["after"],
+            cpu=config["cpu"],
+            net=config["net"],
+            action=config["action"],
+            exclude=config["exclude"],
+        )
+
+    def admission_policy(self) -> "AdmissionPolicy":
+        config = self.section("admission")
+        return AdmissionPolicy(
+            action=config["action"],
+            host_reserve=config["host_reserve"] * MIB,
+            min_memory=config["min_memory"] * MIB,
+            max_load=config["max_load"],
+            queue_timeout=config["queue_timeout"],
+        )
+
+
+class IdlePolicy:
+    """When a running VM counts as idle, and what happens to it then.
+
+    libvirt has no input statistics. Input reaches AppVMs over ssh or
+    waypipe, so network traffic stands in for it, next to guest CPU time.
+    """
+
+    def __init__(
+        self,
+        after: float = 900.0,
+        cpu: float = 0.02,
+        net: float = 4096,
+        action: str = "suspend",
+        exclude: Optional[list[str]] = None,
+    ) -> None:
+        if action not in IDLE_ACTIONS:
+            raise ValueError(f"Unknown idle action: {action}")
+        self.after = after
+        self.cpu = cpu
+        self.net = net
+        self.action = action
+        self.exclude = exclude or []
+
+    def active(self, entry: dict[str, Any]) -> bool:
+        net = entry["net_rx_rate"] + entry["net_tx_rate"]
+        return entry["cpu_time_rate"] >= self.cpu or net >= self.net
+
+
+class IdleReaper:
+    """Suspends vixos VMs that stay idle longer than the policy allows.
+
+    Suspended VMs keep their memory, reaping frees CPU time only. Unclaimed
+    pool domains are idle by design and never reaped.
+    """
+
+    def __init__(self, conn, policy: IdlePolicy, state_path: Path) -> None:
+        self.conn = conn
+        self.policy = policy
+        self.state_path = state_path
+        self.previous: dict[str, dict[str, Any]] = {}
+        self.idle_since: dict[str, float] = {}
+
+    def watched(self, entry: dict[str, Any]) -> bool:
+        if entry["state"] != "running" or entry["package"] in self.policy.exclude:
+            return False
+        try:
+            dom = self.conn.lookupByName(entry["name"])
+        except libvirt.libvirtError:
+            return False  # Domain went away in the meantime.
+        return domain_description(dom) != UNCLAIMED
+
+    def reap(self, package: str) -> str:
+        from .appvm import AppVM
+
+        AppVM(package).pause(self.conn)
+        return self.policy.action
+
+    def step(self, dry_run: bool = False) -> list[dict[str, Any]]:
+        now = time.monotonic()
+        entries = rates(self.previous, collect(self.conn))
+        decisions = []
+        for entry in entries:
+            name = entry["name"]
+            # Rates need two samples.
+            if name not in self.previous or not self.watched(entry):
+                self.idle_since.pop(name, None)
+                continue
+            if self.policy.active(entry):
+                self.idle_since.pop(name, None)
+            idle = now - self.idle_since.setdefault(name, now)
+            action = None
+            if idle >= self.policy.after:
+                action = self.policy.action
+                if not dry_run:
+                    action = self.reap(entry["package"])
+                    del self.idle_since[name]
+            decisions.append(
+                {
+                    "domain": name,
+                    "idle": idle,
+                    "cpu": entry["cpu_time_rate"],
+                    "net": entry["net_rx_rate"] + entry["net_tx_rate"],
+                    "action": action,
+                }
+            )
+        self.previous = {entry["name"]: entry for entry in entries}
+
+        self.state_path.write_text(
+            json.dumps({"time": time.time(), "decisions": decisions}, indent=2)
+        )
+        return decisions
+
+    def run(
+        self, interval: float, dry_run: bool = False
+    ) -> Iterator[list[dict[str, Any]]]:
+        while True:
+            yield self.step(dry_run)
+            time.sleep(interval)
+
+
+class AdmissionPolicy:
+    """Whether a new VM may start, memory values are in KiB.
+
+    The host is under pressure when it can't keep host_reserve available
+    after the initial memory of the VM, or when its load per CPU is above
+    max_load. A launch is then queued until the pressure goes away (at
+    most queue_timeout seconds), downsized or rejected. Downsizing caps the
+    maximum memory of the VM at what the host has left, it doesn't help
+    against CPU load, so such launches are queued.
+    """
+
+    def __init__(
+        self,
+        action: str = "queue",
+        host_reserve: int = 1024 * MIB,
+        min_memory: int = 512 * MIB,
+        max_load: float = 1.5,
+        queue_timeout: float = 300.0,
+        poll: float = 2.0,
+    ) -> None:
+        if action not in ADMISSION_ACTIONS:
+            raise ValueError(f"Unknown admission action: {action}")
+        self.action = action
+        self.host_reserve = host_reserve
+        self.min_memory = min_memory
+        self.max_load = max_load
+        self.queue_timeout = queue_timeout
+        self.poll = poll
+
+    def decide(
+        self, available: int, load: float, action: Optional[str] = None
+    ) -> tuple[str, int, str]:
+        """Returns admit, queue, downsize or reject, the memory and why."""
+        action = action or self.action
+        headroom = available - self.host_reserve
+        if load > self.max_load:
+            reason = f"host load {load:.2f} per CPU"
+            return "reject" if action == "reject" else "queue", VM_MEMORY, reason
+
+        # Round down to 256 MiB, like libvirt would align it anyway.
+        capped = headroom // (256 * MIB) * (256 * MIB)
+        if headroom >= VM_CURRENT_MEMORY:
+            if action == "downsize" and capped < VM_MEMORY:
+                return "downsize", capped, f"{capped // MIB} MiB left for guests"
+            return "admit", VM_MEMORY, "no pressure"
+
+        reason = f"{available // MIB} MiB available"
+        if action == "downsize" and capped >= self.min_memory:
+            return "downsize", capped, reason
+        return "queue" if action == "queue" else "reject", VM_MEMORY, reason
+
+
+def recent_launches(now: float) -> int:
+    with RECENT_LOCK:
+        RECENT_LAUNCHES[:] = [l for l in RECENT_LAUNCHES if now - l[0] < SETTLE_TIME]
+        return sum(memory for _, memory in RECENT_LAUNCHES)
+
+
+def admit(policy: AdmissionPolicy, name: str, action: Optional[str] = None) -> int:
+    """Wait until the VM name may start, returns its maximum memory (KiB).
+
+    Raises AdmissionRejected if it may not start.
+    """
+    deadline = time.monotonic() + policy.queue_timeout
+    queued = False
+    while True:
+        now = time.monotonic()
+        available = host_meminfo()["MemAvailable"] - recent_launches(now)
+        decision, memory, reason = policy.decide(available, host_load(), action)
+        if decision in ("admit", "downsize"):
+            if decision == "downsize":
+                print(f"Starting {name} with at most {memory // MIB} MiB ({reason})")
+            with RECENT_LOCK:
+                RECENT_LAUNCHES.append((now, min(memory, VM_CURRENT_MEMORY)))
+            return memory
+        if decision == "reject" or now >= deadline:
+            raise AdmissionRejected(f"Not starting {name}, host under pressure: {reason}")
+        if not queued:
+            print(f"Host under pressure ({reason}), {name} is queued")
+            queued = True
+        time.sleep(policy.poll)
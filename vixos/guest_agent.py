@@ -0,0 +1,293 @@
+"""vixos guest agent, runs inside AppVMs (deployed by managed.nix).
+
+Listens on virtio-vsock, so the host can control the VM without
+networking. Any host process can connect to a vsock port, so every
+connection starts with a {"nonce": <hex>} line from the agent, and the
+request must carry its RSA PKCS#1 v1.5 SHA-256 signature by the vixos
+key (the one ssh uses, its public key is in AUTHORIZED_KEY). One request
+per connection, as a json line:
+{"method": "exec", "params": {...}, "signature": <base64>}. Answers are
+json lines with {"result": ...} or {"error": "..."}, see vixos/agent.py
+for the client.
+
+- exec streams {"stream": "stdout"|"stderr", "data": <base64>} lines
+  before the result ({"exit_code": ..., "timed_out": ...}).
+- read answers {"result": {"size": ...}}, followed by the raw file content.
+- write answers {"result": null} once the file is open, then reads raw
+  content until the host shuts down its side, and answers again with
+  {"result": {"written": ...}}.
+
+File methods (stat, listdir, makedirs, read, write) run with the
+privileges of their "user" parameter ("user" by default), exec runs its
+command as that user.
+
+Only the Python standard library may be used here.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import pwd
+import selectors
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+PORT = 1024
+
+# Written by managed.nix.
+AUTHORIZED_KEY = "/etc/vixos/agent.pub"
+
+NONCE_SIZE = 32
+
+# DER prefix of a SHA-256 DigestInfo (RFC 8017, section 9.2).
+SHA256_PREFIX = bytes.fromhex("3031300d060960864801650304020105000420")
+
+CHUNK_SIZE = 1024 * 1024
+
+# PATH of commands, login shells extend it (see /etc/profile).
+PATH = "/run/wrappers/bin:/run/current-system/sw/bin"
+
+
+def send(conn, message):
+    conn.sendall(json.dumps(message).encode() + b"\n")
+
+
+def load_public_key(path):
+    """Exponent and modulus of an OpenSSH ssh-rsa public key."""
+    with open(path) as f:
+        blob = base64.b64decode(f.read().split()[1])
+    fields = []
+    while blob:
+        length = int.from_bytes(blob[:4], "big")
+        fields.append(blob[4 : 4 + length])
+        blob = blob[4 + length :]
+    _, e, n = fields
+    return int.from_bytes(e, "big"), int.from_bytes(n, "big")
+
+
+def verify(key, message, signature):
+    e, n = key
+    size = (n.bit_length() + 7) // 8
+    value = int.from_bytes(signature, "big")
+    if len(signature) != size or value >= n:
+        return False
+    digest = SHA256_PREFIX + hashlib.sha256(message).digest()
+    expected = b"\x00\x01" + b"\xff" * (size - len(digest) - 3) + b"\x00" + digest
+    return hmac.compare_digest(pow(value, e, n).to_bytes(size, "big"), expected)
+
+
+def drop_privileges(user):
+    entry = pwd.getpwnam(user)
+    os.setgroups(os.getgrouplist(user, entry.pw_gid))
+    os.setresgid(entry.pw_gid, entry.pw_gid, entry.pw_gid)
+    os.setresuid(entry.pw_uid, entry.pw_uid, entry.pw_uid)
+
+
+def runtime_dir(entry):
+    """/run/user/<uid>, created like logind does if no session made it yet."""
+    path = f"/run/user/{entry.pw_uid}"
+    if not os.path.isdir(path):
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        os.chown(path, entry.pw_uid, entry.pw_gid)
+    return path
+
+
+def session_env(user, entry):
+    """What a PAM session (as ssh had) provides, login shells add the rest."""
+    runtime = runtime_dir(entry)
+    return {
+        "HOME": entry.pw_dir,
+        "USER": user,
+        "LOGNAME": user,
+        "SHELL": entry.pw_shell,
+        "PATH": PATH,
+        "XDG_RUNTIME_DIR": runtime,
+        "DBUS_SESSION_BUS_ADDRESS": f"unix:path={runtime}/bus",
+    }
+
+
+def handle_exec(conn, params):
+    user = params.get("user", "user")
+    entry = pwd.getpwnam(user)
+    process = subprocess.Popen(
+        ["bash", "-lc", params["command"]],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        user=entry.pw_uid,
+        group=entry.pw_gid,
+        extra_groups=os.getgrouplist(user, entry.pw_gid),
+        cwd=entry.pw_dir,
+        env=session_env(user, entry),
+        start_new_session=True,
+    )
+    timeout = params.get("timeout")
+    deadline = time.monotonic() + timeout if timeout else None
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, "stdout")
+    selector.register(process.stderr, selectors.EVENT_READ, "stderr")
+    timed_out = False
+    while selector.get_map():
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            timed_out = True
+            os.killpg(process.pid, signal.SIGKILL)
+            break
+        for key, _ in selector.select(remaining):
+            data = os.read(key.fileobj.fileno(), CHUNK_SIZE)
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            encoded = base64.b64encode(data).decode()
+            send(conn, {"stream": key.data, "data": encoded})
+    exit_code = process.wait()
+    return {"exit_code": None if timed_out else exit_code, "timed_out": timed_out}
+
+
+def handle_stat(conn, params):
+    try:
+        st = os.stat(params["path"])
+    except FileNotFoundError:
+        return None
+    return {"mode": st.st_mode, "size": st.st_size, "mtime": st.st_mtime}
+
+
+def handle_listdir(conn, params):
+    return os.listdir(params["path"])
+
+
+def handle_makedirs(conn, params):
+    path = params["path"]
+    missing = []
+    while path and not os.path.exists(path):
+        missing.append(path)
+        path = os.path.dirname(path)
+    for path in reversed(missing):
+        os.mkdir(path)
+
+
+def handle_read(conn, params):
+    with open(params["path"], "rb") as f:
+        f.seek(params.get("offset", 0))
+        size = os.fstat(f.fileno()).st_size - f.tell()
+        send(conn, {"result": {"size": size}})
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            conn.sendall(chunk)
+
+
+def handle_write(conn, params):
+    path = params["path"]
+    written = 0
+    with open(path, "ab" if params.get("append") else "wb") as f:
+        send(conn, {"result": None})
+        while True:
+            chunk = conn.recv(CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            written += len(chunk)
+    return {"written": written}
+
+
+def handle_mount(conn, params):
+    # A list of {"tag", "path", "readonly"}, or a single tag and path.
+    mounts = params.get("mounts") or [params]
+    for mount in mounts:
+        path = mount["path"]
+        os.makedirs(path, exist_ok=True)
+        if os.path.ismount(path):
+            continue
+        options = ["-o", "ro"] if mount.get("readonly") else []
+        subprocess.run(
+            ["mount", "-t", "virtiofs", *options, mount["tag"], path],
+            check=True,
+            capture_output=True,
+        )
+
+
+HANDLERS = {
+    "ping": lambda conn, params: "pong",
+    "exec": handle_exec,
+    "stat": handle_stat,
+    "listdir": handle_listdir,
+    "makedirs": handle_makedirs,
+    "read": handle_read,
+    "write": handle_write,
+    "mount": handle_mount,
+}
+
+# Methods that send their own responses, unless they fail.
+STREAMING = {"read"}
+
+# File methods run in a child process with the privileges of params["user"].
+AS_USER = {"stat", "listdir", "makedirs", "read", "write"}
+
+
+def handle(conn, key):
+    with conn:
+        nonce = os.urandom(NONCE_SIZE)
+        send(conn, {"nonce": nonce.hex()})
+        # The reader must be closed, or it keeps the connection open.
+        with conn.makefile("rb") as reader:
+            line = reader.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        signature = base64.b64decode(request.get("signature", ""))
+        if not verify(key, nonce, signature):
+            send(conn, {"error": "Not authorized"})
+            return
+        method, params = request["method"], request.get("params", {})
+        if method not in HANDLERS:
+            send(conn, {"error": f"Unknown method: {method}"})
+            return
+        if method not in AS_USER:
+            dispatch(conn, method, params)
+            return
+        # setresuid applies to the whole process, so the agent forks.
+        pid = os.fork()
+        if pid == 0:
+            try:
+                dispatch(conn, method, params, params.get("user", "user"))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+
+def dispatch(conn, method, params, user=None):
+    try:
+        if user is not None:
+            drop_privileges(user)
+        result = HANDLERS[method](conn, params)
+    except subprocess.CalledProcessError as e:
+        send(conn, {"error": e.stderr.decode().strip() or str(e)})
+        return
+    except Exception as e:
+        send(conn, {"error": f"{type(e).__name__}: {e}"})
+        return
+    if method not in STREAMING:
+        send(conn, {"result": result})
+
+
+def main():
+    key = load_public_key(AUTHORIZED_KEY)
+    server = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+    server.bind((socket.VMADDR_CID_ANY, PORT))
+    server.listen()
+    while True:
+        conn, (cid, _) = server.accept()
+        if cid != socket.VMADDR_CID_HOST:
+            conn.close()
+            continue
+        threading.Thread(target=handle, args=(conn, key), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import json
+import os
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Any, Optional
+from .lazy import lazy_import
+from .stats import format_bytes
+
+libvirt = lazy_import("libvirt")
+
+KSM_PATH = Path("/sys/kernel/mm/ksm")
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Applied while dedup domains run, ~/vixos/ksm.json overrides them. Zero
+# pages (a lot of them in fresh guests) are merged into the zero page.
+DEFAULT_TUNING: dict[str, int] = {
+    "run": 1,
+    "pages_to_scan": 1000,
+    "sleep_millisecs": 20,
+    "use_zero_pages": 1,
+}
+
+# Host wide counters, in pages (general_profit is in bytes, Linux 6.1+).
+HOST_COUNTERS = [
+    "pages_shared",
+    "pages_sharing",
+    "pages_unshared",
+    "pages_volatile",
+    "full_scans",
+    "general_profit",
+]
+
+
+def read_value(path: Path) -> Optional[int]:
+    try:
+        return int(path.read_text().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def host_ksm() -> dict[str, Optional[int]]:
+    return {name: read_value(KSM_PATH / name) for name in ["run"] + HOST_COUNTERS}
+
+
+def qemu_pid(name: str) -> Optional[int]:
+    return read_value(Path(f"/run/libvirt/qemu/{name}.pid"))
+
+
+def process_ksm(pid: int) -> Optional[dict[str, int]]:
+    """Merged pages of a process, from /proc/<pid>/ksm_stat (Linux 6.1+)."""
+    try:
+        text = Path(f"/proc/{pid}/ksm_stat").read_text()
+    except OSError:
+        # Older kernels only have the number of merged pages.
+        merging = read_value(Path(f"/proc/{pid}/ksm_merging_pages"))
+        return None if merging is None else {"ksm_merging_pages": merging}
+    result = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(" ")
+        if value.strip().lstrip("-").isdigit():
+            result[name] = int(value)
+    return result
+
+
+def is_dedup(dom) -> bool:
+    """Whether the domain was started with mergeable memory."""
+    backing = ET.fromstring(dom.XMLDesc()).find("memoryBacking")
+    if backing is None:
+        return True
+    return backing.find("nosharepages") is None and backing.find("source") is None
+
+
+def vixos_domains(conn) -> list:
+    domains = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+    return [dom for dom in domains if dom.name().startswith("vixos_")]
+
+
+def collect(conn) -> list[dict[str, Any]]:
+    """Merged pages and RSS (bytes) of every running vixos domain."""
+    result = []
+    for dom in vixos_domains(conn):
+        pid = qemu_pid(dom.name())
+        stats = process_ksm(pid) if pid is not None else None
+        merging = stats.get("ksm_merging_pages") if stats else None
+        try:
+            rss = dom.memoryStats().get("rss", 0) * 1024
+        except libvirt.libvirtError:
+            rss = 0
+        result.append(
+            {
+                "name": dom.name(),
+                "dedup": is_dedup(dom),
+                "merging_pages": merging,
+                "saved": merging * PAGE_SIZE if merging is not None else None,
+                "profit": stats.get("ksm_process_profit") if stats else None,
+                "rss": rss,
+            }
+        )
+    return result
+
+
+class KsmTuner:
+    """Applies the KSM tuning while dedup domains run.
+
+    The host's own settings are saved to ~/vixos/ksm-state.json when the
+    first dedup domain starts and restored once none is left. Writing to
+    /sys/kernel/mm/ksm needs root, without it the settings stay untouched.
+    """
+
+    def __init__(self, vixos_root: Path) -> None:
+        self.config_path = vixos_root / "ksm.json"
+        self.state_path = vixos_root / "ksm-state.json"
+
+    def tuning(self) -> dict[str, int]:
+        tuning = dict(DEFAULT_TUNING)
+        if self.config_path.exists():
+            tuning.update(json.loads(self.config_path.read_text()))
+        return tuning
+
+    @staticmethod
+    def write(settings: dict[str, int]) -> None:
+        for name, value in settings.items():
+            path = KSM_PATH / name
+            if path.exists():
+                path.write_text(f"{value}\n")
+
+    def update(self, conn, dedup: bool = False) -> Optional[str]:
+        """Tune or restore KSM. Returns "tuned", "restored" or None.
+
+        dedup says whether the caller just started a dedup domain, without
+        it (and without saved settings) no domain has to be looked at.
+        """
+        tuned = self.state_path.exists()
+        if not dedup and not tuned:
+            return None
+        active = dedup or any(is_dedup(dom) for dom in vixos_domains(conn))
+        try:
+            if active and not tuned:
+                tuning = self.tuning()
+                original = {name: read_value(KSM_PATH / name) for name in tuning}
+                self.write(tuning)
+                self.state_path.write_text(json.dumps(original))
+                return "tuned"
+            if not active and tuned:
+                original = json.loads(self.state_path.read_text())
+                self.write({k: v for k, v in original.items() if v is not None})
+                self.state_path.unlink()
+                return "restored"
+        except PermissionError:
+            print(f"KSM settings in {KSM_PATH} need root, not tuning them")
+        return None
+
+
+def format_size(value: Optional[float]) -> str:
+    return format_bytes(value) if value is not None else "-"
+
+
+def format_ksm(entries: list[dict[str, Any]], host: dict[str, Optional[int]]) -> str:
+    lines = [f"{'NAME':<28} {'DEDUP':<5} {'MERGED':>8} {'SAVED':>7} {'PROFIT':>7}"]
+    for e in entries:
+        merging = e["merging_pages"] if e["merging_pages"] is not None else "-"
+        lines.append(
+            f"{e['name']:<28} {'yes' if e['dedup'] else 'no':<5} {merging:>8} "
+            f"{format_size(e['saved']):>7} {format_size(e['profit']):>7}"
+        )
+
+    shared, sharing = host["pages_shared"], host["pages_sharing"]
+    if shared is None or sharing is None:
+        lines.append("KSM is not available on this host")
+        return "\n".join(lines)
+    state = "running" if host["run"] == 1 else "stopped"
+    saved = sharing * PAGE_SIZE
+    lines.append(
+        f"Host: KSM {state}, {shared} shared pages used by {sharing} mappings, "
+        f"{format_bytes(saved)} saved, {host['full_scans']} full scans"
+    )
+    if host["general_profit"] is not None:
+        profit = format_bytes(host["general_profit"])
+        lines.append(f"Profit (saved minus KSM metadata): {profit}")
+    rss = [e["rss"] for e in entries if e["rss"]]
+    if rss:
+        average = sum(rss) / len(rss)
+        lines.append(
+            f"Room for about {saved / average:.1f} more VMs "
+            f"at the average RSS of {format_bytes(average)}"
+        )
+    return "\n".join(lines)
@@ -1,6 +1,9 @@
-import libvirt
+import xml.etree.ElementTree as ET
 from contextlib import contextmanager
 from typing import Any
+from .lazy import lazy_import
+
+libvirt = lazy_import("libvirt")
 
 
 @contextmanager
@@ -12,3 +15,8 @@ def libvirt_connection(uri: str) -> Any:
         yield conn
     finally:
         conn.close()
+
+
+def is_gui(dom) -> bool:
+    """Whether the domain was started with a graphical console."""
+    return ET.fromstring(dom.XMLDesc()).find("devices/graphics") is not None
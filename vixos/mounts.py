@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import threading
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Any, Optional
+from .lazy import lazy_import
+from .shares import DEFAULT_SHARES
+from .template_xml import generate_mount_xml
+
+libvirt = lazy_import("libvirt")
+
+CACHE_MODES = ("none", "auto", "always")
+
+
+class MountSpec:
+    """A host directory shared with a VM over virtiofs, and its options."""
+
+    def __init__(
+        self,
+        source: str,
+        destination: Optional[str] = None,
+        cache: str = DEFAULT_SHARES["cache"],
+        thread_pool: int = DEFAULT_SHARES["thread_pool"],
+        readonly: bool = False,
+        xattr: bool = True,
+        queue: int = 1024,
+    ) -> None:
+        if cache not in CACHE_MODES:
+            raise ValueError(f"Unknown virtiofs cache mode: {cache}")
+        self.source = os.path.abspath(source)
+        self.destination = destination or self.source
+        self.cache = cache
+        self.thread_pool = thread_pool
+        self.readonly = readonly
+        self.xattr = xattr
+        self.queue = queue
+
+    @classmethod
+    def parse(cls, spec: str, **defaults: Any) -> "MountSpec":
+        """Parse `SOURCE[:DESTINATION[:OPTIONS]]`.
+
+        OPTIONS is a comma separated list of ro, rw, noxattr, cache=MODE,
+        threads=N and queue=N, overriding the defaults for this mount.
+        """
+        source, _, rest = spec.partition(":")
+        destination, _, options = rest.partition(":")
+        kwargs = dict(defaults)
+        for option in filter(None, options.split(",")):
+            name, _, value = option.partition("=")
+            if name in ("ro", "rw"):
+                kwargs["readonly"] = name == "ro"
+            elif name == "noxattr":
+                kwargs["xattr"] = False
+            elif name == "cache":
+                kwargs["cache"] = value
+            elif name == "threads":
+                kwargs["thread_pool"] = int(value)
+            elif name == "queue":
+                kwargs["queue"] = int(value)
+            else:
+                raise ValueError(f"Unknown mount option: {option}")
+        return cls(source, destination or None, **kwargs)
+
+    @property
+    def tag(self) -> str:
+        # virtiofs tags are limited to 36 bytes, so paths can't be used.
+        digest = hashlib.sha256(self.destination.encode()).hexdigest()
+        return f"mount-{digest[:12]}"
+
+    def xml(self) -> str:
+        return generate_mount_xml(
+            self.source,
+            self.tag,
+            self.cache,
+            self.thread_pool,
+            self.xattr,
+            self.queue,
+        )
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "source": self.source,
+            "destination": self.destination,
+            "cache": self.cache,
+            "thread_pool": self.thread_pool,
+            "readonly": self.readonly,
+            "xattr": self.xattr,
+            "queue": self.queue,
+        }
+
+
+class MountInventory:
+    """Filesystems attached to a running domain, keyed by mount tag.
+
+    The domain XML is parsed once, after that the inventory is kept in
+    sync by attach() and, when a libvirt event loop runs (in vixosd), by
+    device events. It is saved per domain UUID, so short-lived CLI
+    processes don't re-read the XML either.
+    """
+
+    def __init__(self, dom, state_path: Path) -> None:
+        self.dom = dom
+        self.state_path = state_path
+        self.uuid = dom.UUIDString()
+        self.lock = threading.Lock()
+        self.callbacks: list[int] = []
+        self.mounts: dict[str, dict[str, Any]] = {}
+        self.load()
+
+    def load(self) -> None:
+        if self.state_path.exists():
+            state = json.loads(self.state_path.read_text())
+            if state["domain"] == self.uuid:
+                self.mounts = state["mounts"]
+                return
+        self.refresh()
+
+    def refresh(self) -> None:
+        with self.lock:
+            self.mounts = {}
+            root = ET.fromstring(self.dom.XMLDesc())
+            for fs in root.iterfind("devices/filesystem"):
+                target = fs.find("target")
+                if target is None:
+                    continue
+                source = fs.find("source")
+                alias = fs.find("alias")
+                self.mounts[target.get("dir")] = {
+                    "source": source.get("dir") if source is not None else None,
+                    "alias": alias.get("name") if alias is not None else None,
+                }
+            self.save()
+
+    def save(self) -> None:
+        self.state_path.write_text(
+            json.dumps({"domain": self.uuid, "mounts": self.mounts}, indent=2)
+        )
+
+    def has(self, tag: str) -> bool:
+        return tag in self.mounts
+
+    def attach(self, specs: list[MountSpec]) -> list[MountSpec]:
+        """Hot-plug the devices of specs not attached yet, return them."""
+        attached = []
+        with self.lock:
+            for spec in specs:
+                if spec.tag in self.mounts:
+                    continue
+                # Added first, so our own device event is recognised.
+                self.mounts[spec.tag] = dict(spec.to_json(), alias=f"ua-{spec.tag}")
+                try:
+                    self.dom.attachDeviceFlags(
+                        spec.xml(), libvirt.VIR_DOMAIN_AFFECT_LIVE
+                    )
+                except Exception:
+                    del self.mounts[spec.tag]
+                    raise
+                attached.append(spec)
+            if attached:
+                self.save()
+        return attached
+
+    def on_device_removed(self, conn, dom, alias: str, opaque: Any) -> None:
+        with self.lock:
+            for tag, entry in list(self.mounts.items()):
+                if entry.get("alias") == alias:
+                    del self.mounts[tag]
+            self.save()
+
+    def on_device_added(self, conn, dom, alias: str, opaque: Any) -> None:
+        if not any(entry.get("alias") == alias for entry in self.mounts.values()):
+            # Attached by someone else, the source is only in the XML.
+            self.refresh()
+
+    def register_events(self, conn) -> None:
+        for event, callback in [
+            (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED, self.on_device_removed),
+            (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED, self.on_device_added),
+        ]:
+            self.callbacks.append(
+                conn.domainEventRegisterAny(self.dom, event, callback, None)
+            )
+
+    def deregister_events(self, conn) -> None:
+        for callback in self.callbacks:
+            try:
+                conn.domainEventDeregisterAny(callback)
+            except libvirt.libvirtError:
+                pass
+        self.callbacks = []
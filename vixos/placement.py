@@ -0,0 +1,224 @@
+import fcntl
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+from .lazy import lazy_import
+
+libvirt = lazy_import("libvirt")
+
+DEFAULT_VCPUS = 4
+
+# Placement of domains without a placement.json, per package settings
+# there are merged over "default". mode is one of: "off" (no pinning),
+# "shared" (pin to the least loaded cores of one NUMA node) and
+# "dedicated" (cores not used by other VMs).
+DEFAULT_CONFIG: dict[str, Any] = {
+    "default": {"mode": "off", "vcpus": DEFAULT_VCPUS, "hugepages": False},
+    "packages": {},
+}
+
+# Dedicated cores are recorded before the domain exists, entries of
+# domains that didn't show up within this many seconds are dropped.
+RESERVATION_GRACE = 120.0
+
+
+def parse_cpulist(text: str) -> list[int]:
+    """Parse a kernel cpulist like `0-3,8-11`."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus: list[int]) -> str:
+    return ",".join(str(cpu) for cpu in sorted(cpus))
+
+
+def host_numa_nodes() -> dict[int, list[int]]:
+    """Map NUMA node id to its cpus."""
+    nodes = {}
+    root = Path("/sys/devices/system/node")
+    for node in sorted(root.glob("node[0-9]*")):
+        cpus = parse_cpulist((node / "cpulist").read_text())
+        if cpus:
+            nodes[int(node.name[len("node") :])] = cpus
+    if not nodes:
+        nodes[0] = list(range(os.cpu_count() or 1))
+    return nodes
+
+
+class Placement:
+    def __init__(
+        self,
+        vcpus: int,
+        vcpu_pins: list[int],
+        emulator_pin: list[int],
+        node: Optional[int],
+        hugepages: bool,
+        strict: bool = False,
+    ) -> None:
+        self.vcpus = vcpus
+        self.vcpu_pins = vcpu_pins
+        self.emulator_pin = emulator_pin
+        self.node = node
+        self.hugepages = hugepages
+        # Strict NUMA memory binding, otherwise the node is only preferred.
+        self.strict = strict
+
+
+class PlacementScheduler:
+    """Assigns vCPU/emulator pins and a NUMA node to a new AppVM domain.
+
+    Cpus already pinned by running vixos domains (as reported by libvirt)
+    count as load, so VMs are spread over cores and nodes. Cores given to
+    "dedicated" domains are recorded in placement.json ("dedicated", by
+    domain name) and never used by other domains or emulator threads.
+    Placing holds placement.lock, so concurrent vixos processes (and
+    vixosd) don't hand out the same cores.
+    """
+
+    def __init__(self, conn, config_path: Path) -> None:
+        self.conn = conn
+        self.config_path = config_path
+        self.lock_path = config_path.with_name("placement.lock")
+        self.load()
+
+    def load(self) -> None:
+        self.config = DEFAULT_CONFIG
+        if self.config_path.exists():
+            self.config = json.loads(self.config_path.read_text())
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        # placement.json is replaced when saved, so a separate file is locked.
+        with open(self.lock_path, "w") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def package_config(self, package: str) -> dict[str, Any]:
+        config = dict(DEFAULT_CONFIG["default"])
+        config.update(self.config.get("default", {}))
+        config.update(self.config.get("packages", {}).get(package, {}))
+        return config
+
+    def cpu_load(self, exclude: Optional[str] = None) -> Counter:
+        """Count vcpus pinned to every host cpu by other vixos domains."""
+        load: Counter = Counter()
+        domains = self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        for dom in domains:
+            if not dom.name().startswith("vixos_") or dom.name() == exclude:
+                continue
+            try:
+                cpumaps = dom.vcpuPinInfo(libvirt.VIR_DOMAIN_AFFECT_LIVE)
+            except libvirt.libvirtError:
+                continue
+            for cpumap in cpumaps:
+                pinned = [cpu for cpu, allowed in enumerate(cpumap) if allowed]
+                if len(pinned) < len(cpumap):  # Unpinned vcpus float everywhere.
+                    load.update(pinned)
+        return load
+
+    def dedicated_cores(self, exclude: Optional[str] = None) -> set[int]:
+        """Cores of running (or just placed) dedicated domains."""
+        active = {
+            dom.name()
+            for dom in self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        }
+        now = time.time()
+        dedicated = {
+            name: entry
+            for name, entry in self.config.get("dedicated", {}).items()
+            if name in active or now - entry["time"] < RESERVATION_GRACE
+        }
+        if dedicated != self.config.get("dedicated", {}):
+            self.save_dedicated(dedicated)
+        return {
+            cpu
+            for name, entry in dedicated.items()
+            if name != exclude
+            for cpu in entry["cpus"]
+        }
+
+    def save_dedicated(self, dedicated: dict[str, Any]) -> None:
+        self.config = dict(self.config, dedicated=dedicated)
+        tmp = self.config_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.config, indent=2))
+        tmp.replace(self.config_path)
+
+    def place(self, package: str, vm_name: str) -> Placement:
+        with self.locked():
+            # Another process may have dedicated cores since we loaded.
+            self.load()
+            return self.choose(package, vm_name)
+
+    def choose(self, package: str, vm_name: str) -> Placement:
+        config = self.package_config(package)
+        vcpus = int(config["vcpus"])
+        hugepages = bool(config["hugepages"])
+        mode = config["mode"]
+        if mode == "off":
+            return Placement(vcpus, [], [], None, hugepages)
+
+        load = self.cpu_load(exclude=vm_name)
+        reserved = self.dedicated_cores(exclude=vm_name)
+        nodes = {
+            node: [cpu for cpu in cpus if cpu not in reserved]
+            for node, cpus in host_numa_nodes().items()
+        }
+        nodes = {node: cpus for node, cpus in nodes.items() if cpus}
+        if not nodes:
+            raise RuntimeError(f"All cores are dedicated to other VMs, can't place {package}")
+
+        def node_load(node: int) -> tuple[int, int]:
+            cpus = nodes[node]
+            free = sum(1 for cpu in cpus if load[cpu] == 0)
+            return (-free, sum(load[cpu] for cpu in cpus))
+
+        node = config.get("node")
+        if node is None:
+            node = min(nodes, key=node_load)
+        elif node not in nodes:
+            raise RuntimeError(f"All cores of NUMA node {node} are dedicated to other VMs")
+        cpus = sorted(nodes[node], key=lambda cpu: (load[cpu], cpu))
+
+        if mode == "dedicated":
+            free = [cpu for cpu in cpus if load[cpu] == 0]
+            # Keep the first core of the node for emulator threads and the host.
+            free = free[1:] if len(free) > vcpus else free
+            if len(free) < vcpus:
+                raise RuntimeError(
+                    f"Not enough free cores on NUMA node {node} for {vcpus} "
+                    f"dedicated vcpus of {package}"
+                )
+            vcpu_pins = free[:vcpus]
+            emulator_pin = [cpu for cpu in nodes[node] if cpu not in vcpu_pins]
+            dedicated = dict(self.config.get("dedicated", {}))
+            dedicated[vm_name] = {"cpus": vcpu_pins, "time": time.time()}
+            self.save_dedicated(dedicated)
+        elif mode == "shared":
+            vcpu_pins = [cpus[i % len(cpus)] for i in range(vcpus)]
+            emulator_pin = nodes[node]
+        else:
+            raise ValueError(f"Unknown placement mode: {mode}")
+
+        return Placement(
+            vcpus,
+            vcpu_pins,
+            emulator_pin or nodes[node],
+            node,
+            hugepages,
+            strict=mode == "dedicated",
+        )
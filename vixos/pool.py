@@ -0,0 +1,239 @@
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+from .lazy import lazy_import
+
+libvirt = lazy_import("libvirt")
+
+# Unclaimed pool domains are marked with this libvirt domain description.
+UNCLAIMED = "vixos-pool:unclaimed"
+CLAIMED = "vixos-pool:claimed"
+
+# Extra kernel parameter, makes the app runner wait for injected arguments.
+POOL_CMDLINE = "vixos.pool=1"
+
+# How many claim latencies to keep for statistics.
+MAX_LATENCIES = 100
+
+
+def domain_description(dom) -> Optional[str]:
+    try:
+        return dom.metadata(libvirt.VIR_DOMAIN_METADATA_DESCRIPTION, None)
+    except libvirt.libvirtError:
+        return None
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class WarmPool:
+    """Keeps pre-booted, unclaimed AppVM domains for configured packages.
+
+    Configuration lives in ~/vixos/pool.json, for example:
+
+        {"max_total": 8, "packages": {"firefox": {"size": 2, "gui": true}}}
+
+    Packages may also set executable, fast_boot and dedup. A run only
+    claims a domain booted with the same settings.
+    """
+
+    def __init__(self, vixos_root: Path) -> None:
+        self.vixos_root = vixos_root
+        self.config_path = vixos_root / "pool.json"
+        self.stats_path = vixos_root / "pool-stats.json"
+        # Pool domains being booted by `pool fill`, by domain name.
+        self.reserved_path = vixos_root / "pool-reserved.json"
+        self.lock_path = vixos_root / "pool.lock"
+
+    def load_config(self) -> dict[str, Any]:
+        if not self.config_path.exists():
+            return {"max_total": 0, "packages": {}}
+        config = json.loads(self.config_path.read_text())
+        config.setdefault("max_total", 8)
+        config.setdefault("packages", {})
+        return config
+
+    def package_config(self, package: str) -> Optional[dict[str, Any]]:
+        return self.load_config()["packages"].get(package)
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        self.vixos_root.mkdir(exist_ok=True, parents=True)
+        with open(self.lock_path, "w") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    @staticmethod
+    def domain_prefix(package: str) -> str:
+        return f"vixos_{package}_pool_"
+
+    def unclaimed_domains(self, conn, package: Optional[str] = None) -> list:
+        prefix = self.domain_prefix(package) if package else "vixos_"
+        result = []
+        for dom in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+            if not dom.name().startswith(prefix):
+                continue
+            if domain_description(dom) == UNCLAIMED:
+                result.append(dom)
+        return result
+
+    @staticmethod
+    def matches(
+        config: dict[str, Any],
+        package: str,
+        is_gui: bool,
+        executable: str,
+        fast_boot: bool,
+        dedup: bool,
+    ) -> bool:
+        """Whether pool domains of config were booted the way a run asks for."""
+        return (
+            bool(config.get("gui", False)) == is_gui
+            and config.get("executable", package) == executable
+            and bool(config.get("fast_boot", False)) == fast_boot
+            and bool(config.get("dedup", False)) == dedup
+        )
+
+    def claim(
+        self,
+        conn,
+        package: str,
+        is_gui: bool,
+        executable: Optional[str] = None,
+        fast_boot: bool = False,
+        dedup: bool = False,
+    ) -> Optional[Any]:
+        """Claim a pre-booted domain for package, or return None on a miss."""
+        start = time.monotonic()
+        config = self.package_config(package)
+        dom = None
+        if config is not None and self.matches(
+            config, package, is_gui, executable or package, fast_boot, dedup
+        ):
+            with self.locked():
+                candidates = self.unclaimed_domains(conn, package)
+                if candidates:
+                    dom = candidates[0]
+                    dom.setMetadata(
+                        libvirt.VIR_DOMAIN_METADATA_DESCRIPTION,
+                        CLAIMED,
+                        None,
+                        None,
+                        libvirt.VIR_DOMAIN_AFFECT_LIVE,
+                    )
+        self.record(package, dom is not None, time.monotonic() - start)
+        if config is not None:
+            self.refill_in_background(package)
+        return dom
+
+    def fill(self, conn, package: str) -> int:
+        """Boot missing pool domains for package. Returns number of new domains."""
+        from .appvm import AppVM, random_name
+        from .governor import AdmissionRejected
+
+        config = self.package_config(package)
+        if config is None:
+            return 0
+
+        # The lock is only held to reserve slots, booting (with nix-build)
+        # happens outside of it, so claims don't wait for refills.
+        with self.locked():
+            reserved = self.load_reserved()
+            total = len(self.unclaimed_domains(conn)) + len(reserved)
+            current = len(self.unclaimed_domains(conn, package)) + sum(
+                1 for entry in reserved.values() if entry["package"] == package
+            )
+            missing = int(config.get("size", 1)) - current
+            missing = min(missing, int(self.load_config()["max_total"]) - total)
+            names = [
+                self.domain_prefix(package) + random_name() for _ in range(max(missing, 0))
+            ]
+            for vm_name in names:
+                reserved[vm_name] = {"package": package, "pid": os.getpid()}
+            self.save_reserved(reserved)
+
+        appvm = AppVM(package)
+        appvm.fast_boot = bool(config.get("fast_boot", False))
+        appvm.dedup = bool(config.get("dedup", False))
+        started = 0
+        try:
+            for vm_name in names:
+                try:
+                    # Speculative domains never wait for, or squeeze, the host.
+                    dom = appvm.boot(
+                        conn,
+                        bool(config.get("gui", False)),
+                        config.get("executable", package),
+                        vm_name=vm_name,
+                        extra_cmdline=POOL_CMDLINE,
+                        admission="reject",
+                    )
+                except AdmissionRejected as e:
+                    print(e)
+                    break
+                dom.setMetadata(
+                    libvirt.VIR_DOMAIN_METADATA_DESCRIPTION,
+                    UNCLAIMED,
+                    None,
+                    None,
+                    libvirt.VIR_DOMAIN_AFFECT_LIVE,
+                )
+                started += 1
+        finally:
+            with self.locked():
+                reserved = self.load_reserved()
+                for vm_name in names:
+                    reserved.pop(vm_name, None)
+                self.save_reserved(reserved)
+        return started
+
+    def load_reserved(self) -> dict[str, dict[str, Any]]:
+        """Reserved slots, without those of fill processes that died."""
+        if not self.reserved_path.exists():
+            return {}
+        reserved = json.loads(self.reserved_path.read_text())
+        return {
+            name: entry for name, entry in reserved.items() if pid_alive(entry["pid"])
+        }
+
+    def save_reserved(self, reserved: dict[str, dict[str, Any]]) -> None:
+        self.reserved_path.write_text(json.dumps(reserved))
+
+    def refill_in_background(self, package: str) -> None:
+        subprocess.Popen(
+            [sys.executable, "-m", "vixos", "pool", "fill", package],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def load_stats(self) -> dict[str, Any]:
+        if not self.stats_path.exists():
+            return {}
+        return json.loads(self.stats_path.read_text())
+
+    def record(self, package: str, hit: bool, latency: float) -> None:
+        with self.locked():
+            stats = self.load_stats()
+            entry = stats.setdefault(package, {"hits": 0, "misses": 0, "latencies": []})
+            entry["hits" if hit else "misses"] += 1
+            if hit:
+                entry["latencies"] = (entry["latencies"] + [latency])[-MAX_LATENCIES:]
+            self.stats_path.write_text(json.dumps(stats))
@@ -0,0 +1,90 @@
+import enum
+import socket
+import threading
+import time
+from typing import Optional
+from .lazy import lazy_import
+
+libvirt = lazy_import("libvirt")
+
+# virtio-serial port written by the vixos-ready unit in the guest.
+READY_CHANNEL = "org.vixos.ready"
+
+
+class Phase(enum.Enum):
+    IP = "ip"
+    SSHD = "sshd"
+    APP = "app"
+
+
+class ReadinessMonitor:
+    """Reads boot phase notifications sent by the guest over virtio-serial.
+
+    The guest writes one line per phase: `ip <address>`, `sshd` and `app`.
+    Writes on the guest side block until we connect, so nothing is lost
+    when the monitor is attached after the domain has already booted.
+    """
+
+    def __init__(self, conn, dom) -> None:
+        self.events = {phase: threading.Event() for phase in Phase}
+        self.timestamps: dict[Phase, float] = {}
+        self.ip: Optional[str] = None
+        self.stream = conn.newStream(0)
+        dom.openChannel(READY_CHANNEL, self.stream, 0)
+        self.thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def attach(cls, conn, dom) -> Optional["ReadinessMonitor"]:
+        try:
+            return cls(conn, dom)
+        except libvirt.libvirtError:
+            # Domain created before readiness channels were introduced.
+            return None
+
+    def read_loop(self) -> None:
+        buffer = b""
+        while True:
+            try:
+                data = self.stream.recv(1024)
+            except libvirt.libvirtError:
+                return
+            if not isinstance(data, bytes) or not data:
+                return
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                self.handle_line(line.decode(errors="replace").strip())
+
+    def handle_line(self, line: str) -> None:
+        name, _, value = line.partition(" ")
+        try:
+            phase = Phase(name)
+        except ValueError:
+            return
+        if phase == Phase.IP:
+            self.ip = value
+        self.timestamps.setdefault(phase, time.monotonic())
+        self.events[phase].set()
+
+    def wait(self, phase: Phase, timeout: float) -> bool:
+        return self.events[phase].wait(timeout)
+
+    def close(self) -> None:
+        try:
+            self.stream.abort()
+        except libvirt.libvirtError:
+            pass
+
+
+def wait_for_port(host: str, port: int, timeout: float) -> bool:
+    """Fallback readiness check for domains without a monitor."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
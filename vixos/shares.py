@@ -0,0 +1,36 @@
+import json
+from pathlib import Path
+from typing import Any
+
+# Share settings, "default" and "packages" entries in
+# ~/vixos/shares.json are applied on top. mode is "virtiofs" or "9p"
+# (fallback, for example for hosts without virtiofsd). cache is the
+# virtiofsd cache mode ("none", "auto", "always"), thread_pool the
+# virtiofsd thread pool size and dax_window the size of the DAX window
+# in MiB (0 disables DAX). DAX needs a QEMU built with the out-of-tree
+# virtio-fs DAX patches, keep it at 0 with upstream QEMU.
+DEFAULT_SHARES: dict[str, Any] = {
+    "mode": "virtiofs",
+    "cache": "auto",
+    "thread_pool": 16,
+    "dax_window": 0,
+}
+
+
+class SharesConfig:
+    """How /nix/store and the home directory are shared with AppVMs."""
+
+    def __init__(self, config_path: Path) -> None:
+        self.config: dict[str, Any] = {}
+        if config_path.exists():
+            self.config = json.loads(config_path.read_text())
+
+    def for_package(self, package: str) -> dict[str, Any]:
+        config = dict(DEFAULT_SHARES)
+        config.update(self.config.get("default", {}))
+        config.update(self.config.get("packages", {}).get(package, {}))
+        if config["mode"] not in ("virtiofs", "9p"):
+            raise ValueError(f"Unknown share mode: {config['mode']}")
+        if config["cache"] not in ("none", "auto", "always"):
+            raise ValueError(f"Unknown virtiofs cache mode: {config['cache']}")
+        return config
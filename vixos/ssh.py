@@ -1,14 +1,70 @@
+from __future__ import annotations
+
+from functools import cached_property
 from pathlib import Path
-from Crypto.PublicKey import RSA
+import select
 import subprocess
-import paramiko
+import sys
+import threading
+import time
+from typing import Callable, Optional
+from .lazy import lazy_import
+from .tracing import Tracer
+
+paramiko = lazy_import("paramiko")
+RSA = lazy_import("Crypto.PublicKey.RSA")
+
+# Connections unused for this long are closed (paramiko pool and ssh mux).
+IDLE_TIMEOUT = 60
+
+# Larger than paramiko defaults, so bulk SFTP transfers are not window-bound.
+WINDOW_SIZE = 16 * 1024 * 1024
+MAX_PACKET_SIZE = 256 * 1024
+
+# Called with "stdout" or "stderr" and a chunk of output, as it arrives.
+OutputCallback = Callable[[str, bytes], None]
+
+
+def print_output(stream: str, data: bytes) -> None:
+    out = sys.stdout.buffer if stream == "stdout" else sys.stderr.buffer
+    out.write(data)
+    out.flush()
+
+
+class ExecResult:
+    def __init__(
+        self,
+        exit_code: Optional[int],
+        stdout: bytes = b"",
+        stderr: bytes = b"",
+        timed_out: bool = False,
+        duration: float = 0.0,
+        error: Optional[str] = None,
+    ) -> None:
+        # None when the command timed out or couldn't be started.
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.duration = duration
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
 
 
 class SshManager:
-    def __init__(self, vixos_root: Path) -> None:
+    def __init__(self, vixos_root: Path, tracer: Optional[Tracer] = None) -> None:
         self.vixos_root = vixos_root
+        self.tracer = tracer or Tracer()
         self.privkey_path = self.vixos_root / "vixos_id_rsa"
-        self.privkey = self.ensure_privkey()
+        self.control_path = self.vixos_root / "ssh"
+        # One authenticated transport per (user, host), channels are multiplexed.
+        self.connections: dict[
+            tuple[str, str, bool], tuple[paramiko.SSHClient, float]
+        ] = {}
+        self.lock = threading.Lock()
 
     def ensure_privkey(self) -> RSA.RsaKey:
         if not self.privkey_path.exists():
@@ -18,18 +74,39 @@ class SshManager:
 
         return RSA.importKey(self.privkey_path.read_bytes())
 
+    def ensure_key(self) -> None:
+        """Generate the key file if needed, ssh and paramiko read the file."""
+        if not self.privkey_path.exists():
+            self.ensure_privkey()
+
+    @cached_property
+    def privkey(self) -> RSA.RsaKey:
+        # Loaded (or generated) only when a session or the pubkey is needed.
+        return self.ensure_privkey()
+
     @property
     def pubkey_text(self) -> str:
         return self.privkey.publickey().exportKey("OpenSSH").decode()
 
-    def interactive_session(self, user: str, host: str, flags: list[str] = []) -> None:
+    def control_flags(self) -> list[str]:
+        self.control_path.mkdir(exist_ok=True, parents=True)
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_path}/%r@%h:%p",
+            "-o",
+            f"ControlPersist={IDLE_TIMEOUT}",
+        ]
+
+    def ssh_args(self, user: str, host: str, flags: list[str] = []) -> list[str]:
         # TODO: use a hardcoded known host key here instead?
-        # TODO: use paramiko session instead of shelling to ssh?
         flags = flags if flags else []
-        subprocess.check_call(
+        self.ensure_key()
+        return (
             [
                 "ssh",
-                f"user@{host}",
+                f"{user}@{host}",
                 "-i",
                 str(self.privkey_path),
                 "-o",
@@ -37,19 +114,137 @@ class SshManager:
                 "-o",
                 "UserKnownHostsFile=/dev/null",
             ]
+            + self.control_flags()
             + flags
         )
 
-    def ssh_session(self, user: str, host: str) -> paramiko.SSHClient:
+    def interactive_session(self, user: str, host: str, flags: list[str] = []) -> None:
+        # TODO: use paramiko session instead of shelling to ssh?
+        subprocess.check_call(self.ssh_args(user, host, flags))
+
+    def connect(self, user: str, host: str, compress: bool) -> paramiko.SSHClient:
+        self.ensure_key()
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(
-            username=user,
-            hostname=host,
-            key_filename=str(self.privkey_path),
-        )
+        with self.tracer.phase("ssh-connect", user=user, host=host):
+            ssh.connect(
+                username=user,
+                hostname=host,
+                key_filename=str(self.privkey_path),
+                compress=compress,
+            )
+        transport = ssh.get_transport()
+        if transport is not None:
+            # Applies to all channels opened later on this transport.
+            transport.default_window_size = WINDOW_SIZE
+            transport.default_max_packet_size = MAX_PACKET_SIZE
         return ssh
 
+    def expire_idle(self) -> None:
+        now = time.monotonic()
+        for key, (ssh, last_used) in list(self.connections.items()):
+            if now - last_used > IDLE_TIMEOUT:
+                del self.connections[key]
+                ssh.close()
+
+    def ssh_session(
+        self, user: str, host: str, compress: bool = False
+    ) -> paramiko.SSHClient:
+        """Return a pooled client. Callers must not close it."""
+        with self.lock:
+            self.expire_idle()
+            key = (user, host, compress)
+            ssh = None
+            if key in self.connections:
+                ssh, _ = self.connections[key]
+                transport = ssh.get_transport()
+                if transport is None or not transport.is_active():
+                    ssh.close()
+                    ssh = None
+            if ssh is None:
+                ssh = self.connect(user, host, compress)
+            self.connections[key] = (ssh, time.monotonic())
+            return ssh
+
+    def close_host(self, host: str) -> None:
+        """Close pooled clients and ssh masters of a host that went away.
+
+        A new VM can get the same address within ControlPersist, and would
+        be attached to the dead master otherwise.
+        """
+        with self.lock:
+            for key, (ssh, _) in list(self.connections.items()):
+                if key[1] == host:
+                    del self.connections[key]
+                    ssh.close()
+        for socket_path in self.control_path.glob(f"*@{host}:*"):
+            subprocess.run(
+                ["ssh", "-o", f"ControlPath={socket_path}", "-O", "exit", host],
+                capture_output=True,
+            )
+            socket_path.unlink(missing_ok=True)
+
+    def close_all(self) -> None:
+        with self.lock:
+            for ssh, _ in self.connections.values():
+                ssh.close()
+            self.connections.clear()
+
+    def exec(
+        self,
+        user: str,
+        host: str,
+        command: str,
+        timeout: Optional[float] = None,
+        on_output: Optional[OutputCallback] = None,
+        capture: bool = True,
+    ) -> ExecResult:
+        """Run command on a pooled connection, streaming its output.
+
+        Output is passed to on_output as it arrives, and also returned in
+        the result if capture is set. On timeout the channel is closed.
+        """
+        start = time.monotonic()
+        deadline = start + timeout if timeout else None
+        output: dict[str, list[bytes]] = {"stdout": [], "stderr": []}
+        transport = self.ssh_session(user, host).get_transport()
+        channel = transport.open_session()
+        timed_out = False
+        try:
+            channel.exec_command(command)
+            while True:
+                received = False
+                for stream, ready, recv in [
+                    ("stdout", channel.recv_ready, channel.recv),
+                    ("stderr", channel.recv_stderr_ready, channel.recv_stderr),
+                ]:
+                    while ready():
+                        data = recv(MAX_PACKET_SIZE)
+                        received = True
+                        if on_output is not None:
+                            on_output(stream, data)
+                        if capture:
+                            output[stream].append(data)
+                if received:
+                    continue
+                if channel.exit_status_ready() and channel.eof_received:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    timed_out = True
+                    break
+                # The channel fd only signals stdout, so poll stderr too.
+                select.select([channel], [], [], 0.05)
+            exit_code = None if timed_out else channel.recv_exit_status()
+        finally:
+            channel.close()
+        return ExecResult(
+            exit_code,
+            b"".join(output["stdout"]),
+            b"".join(output["stderr"]),
+            timed_out,
+            time.monotonic() - start,
+        )
+
     def get_from_remote(
         self, user: str, host: str, remote_path: str, local_path: str
     ) -> None:
@@ -0,0 +1,171 @@
+import os
+import time
+from typing import Any, Optional
+from .lazy import lazy_import
+
+libvirt = lazy_import("libvirt")
+
+STATE_NAMES = {
+    1: "running",
+    2: "blocked",
+    3: "paused",
+    4: "shutdown",
+    5: "shutoff",
+    6: "crashed",
+    7: "suspended",
+}
+
+
+def stats_flags() -> int:
+    return (
+        libvirt.VIR_DOMAIN_STATS_STATE
+        | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+        | libvirt.VIR_DOMAIN_STATS_BALLOON
+        | libvirt.VIR_DOMAIN_STATS_BLOCK
+        | libvirt.VIR_DOMAIN_STATS_INTERFACE
+    )
+
+
+def sum_counters(record: dict[str, Any], prefix: str, suffix: str) -> int:
+    count = record.get(f"{prefix}.count", 0)
+    return sum(record.get(f"{prefix}.{i}.{suffix}", 0) for i in range(count))
+
+
+def lease_addresses(conn, network: str = "default") -> dict[str, str]:
+    """Map guest hostname to IPv4 address, one call for all domains."""
+    try:
+        leases = conn.networkLookupByName(network).DHCPLeases()
+    except libvirt.libvirtError:
+        return {}
+    return {
+        lease["hostname"]: lease["ipaddr"]
+        for lease in leases
+        if lease.get("hostname") and lease["type"] == libvirt.VIR_IP_ADDR_TYPE_IPV4
+    }
+
+
+def domain_uptime(name: str) -> Optional[float]:
+    # libvirt has no uptime statistic, the qemu pidfile is written on start.
+    try:
+        started = os.stat(f"/run/libvirt/qemu/{name}.pid").st_mtime
+    except OSError:
+        return None
+    return time.time() - started
+
+
+def domain_package(name: str) -> str:
+    return name[len("vixos_") :].split("_pool_")[0]
+
+
+def running_packages(conn) -> list[str]:
+    """Packages with a running vixos domain, unclaimed pool domains excluded."""
+    from .pool import UNCLAIMED, domain_description
+
+    packages = []
+    for dom in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+        name = dom.name()
+        if not name.startswith("vixos_") or domain_description(dom) == UNCLAIMED:
+            continue
+        if domain_package(name) not in packages:
+            packages.append(domain_package(name))
+    return sorted(packages)
+
+
+def collect(conn) -> list[dict[str, Any]]:
+    """Stats of all running vixos domains with one getAllDomainStats call."""
+    records = conn.getAllDomainStats(
+        stats_flags(), libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE
+    )
+    addresses = lease_addresses(conn)
+    result = []
+    for dom, record in records:
+        name = dom.name()
+        if not name.startswith("vixos_"):
+            continue
+        package = domain_package(name)
+        result.append(
+            {
+                "name": name,
+                "package": package,
+                "state": STATE_NAMES.get(record.get("state.state"), "unknown"),
+                "cpu_time": record.get("cpu.time", 0) / 1e9,
+                "memory": record.get("balloon.current", 0) * 1024,
+                "rss": record.get("balloon.rss", 0) * 1024,
+                "disk_read": sum_counters(record, "block", "rd.bytes"),
+                "disk_write": sum_counters(record, "block", "wr.bytes"),
+                "net_rx": sum_counters(record, "net", "rx.bytes"),
+                "net_tx": sum_counters(record, "net", "tx.bytes"),
+                "ip": addresses.get(package),
+                "uptime": domain_uptime(name),
+                "timestamp": time.monotonic(),
+            }
+        )
+    return result
+
+
+def rates(
+    previous: dict[str, dict[str, Any]], current: list[dict[str, Any]]
+) -> list[dict[str, Any]]:
+    """Add per-second rates computed from the previous sample of each domain."""
+    counters = ["disk_read", "disk_write", "net_rx", "net_tx"]
+    result = []
+    for entry in current:
+        entry = dict(entry)
+        before = previous.get(entry["name"])
+        elapsed = entry["timestamp"] - before["timestamp"] if before else 0
+        for counter in ["cpu_time"] + counters:
+            rate = 0.0
+            if before and elapsed > 0:
+                rate = (entry[counter] - before[counter]) / elapsed
+            entry[f"{counter}_rate"] = rate
+        result.append(entry)
+    return result
+
+
+def format_bytes(value: float) -> str:
+    for unit in ["B", "K", "M", "G"]:
+        if abs(value) < 1024:
+            return f"{value:.0f}{unit}"
+        value /= 1024
+    return f"{value:.1f}T"
+
+
+def format_uptime(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    minutes, _ = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m"
+
+
+def format_ps(entries: list[dict[str, Any]]) -> str:
+    lines = [
+        f"{'NAME':<28} {'STATE':<8} {'CPU':>8} {'MEM':>6} {'RSS':>6} "
+        f"{'DISK R/W':>13} {'NET RX/TX':>13} {'IP':<15} {'UP':>7}"
+    ]
+    for e in entries:
+        lines.append(
+            f"{e['name']:<28} {e['state']:<8} {e['cpu_time']:>7.1f}s "
+            f"{format_bytes(e['memory']):>6} {format_bytes(e['rss']):>6} "
+            f"{format_bytes(e['disk_read']) + '/' + format_bytes(e['disk_write']):>13} "
+            f"{format_bytes(e['net_rx']) + '/' + format_bytes(e['net_tx']):>13} "
+            f"{e['ip'] or '-':<15} {format_uptime(e['uptime']):>7}"
+        )
+    return "\n".join(lines)
+
+
+def format_top(entries: list[dict[str, Any]]) -> str:
+    lines = [
+        f"{'NAME':<28} {'CPU%':>6} {'MEM':>6} {'RSS':>6} "
+        f"{'DISK R/s':>9} {'DISK W/s':>9} {'NET RX/s':>9} {'NET TX/s':>9}"
+    ]
+    entries = sorted(entries, key=lambda e: e["cpu_time_rate"], reverse=True)
+    for e in entries:
+        lines.append(
+            f"{e['name']:<28} {e['cpu_time_rate'] * 100:>6.1f} "
+            f"{format_bytes(e['memory']):>6} {format_bytes(e['rss']):>6} "
+            f"{format_bytes(e['disk_read_rate']):>9} "
+            f"{format_bytes(e['disk_write_rate']):>9} "
+            f"{format_bytes(e['net_rx_rate']):>9} {format_bytes(e['net_tx_rate']):>9}"
+        )
+    return "\n".join(lines)
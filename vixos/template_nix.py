@@ -1,4 +1,11 @@
 import os
+from pathlib import Path
+from typing import Any, Optional
+
+
+def nix_indented_string(text: str) -> str:
+    """Quote text as a Nix ''...'' string."""
+    return "''" + text.replace("''", "'''").replace("${", "''${") + "''"
 
 
 def generate_local_nix() -> str:
@@ -12,18 +19,28 @@ def generate_global_nix() -> str:
 }"""
 
 
-def generate_default_nix(package: str, executable: str) -> str:
-    return """{pkgs, ...}:
-let
-  application = "${pkgs.%s}/bin/%s";
+# Starts the application. Shared by per-app systems and overlay profiles.
+app_runner_nix = """
+  application = "${pkgs.%(package)s}/bin/%(executable)s";
   appRunner = pkgs.writeShellScriptBin "app" ''
     ARGS_FILE=/home/user/.args
+    if grep -q vixos.pool=1 /proc/cmdline; then
+      # Pre-booted pool VM, wait until vixos claims it and injects arguments.
+      ARGS_FILE=/run/vixos/args
+      while [ ! -f $ARGS_FILE ]; do sleep 0.05; done
+    fi
     ARGS=$(cat $ARGS_FILE)
     rm $ARGS_FILE
+    touch /run/vixos/app-started
 
     ${application} $ARGS
     systemctl poweroff
-  '';
+  '';"""
+
+
+def generate_default_nix(package: str, executable: str) -> str:
+    return """{pkgs, ...}:
+let%s
 in {
   imports = [
     <nixpkgs/nixos/modules/virtualisation/qemu-vm.nix>
@@ -37,19 +54,163 @@ in {
   services.xserver.displayManager.sessionCommands = "${appRunner}/bin/app &";
 }
 """ % (
+        app_runner_nix % {"package": package, "executable": executable},
+        package,
+    )
+
+
+def generate_overlay_nix(package: str, executable: str) -> str:
+    """Per-app profile booted on top of the shared base system."""
+    return """let
+  pkgs = import <nixpkgs> {};%s
+in pkgs.buildEnv {
+  name = "vixos-app-%s";
+  paths = [ appRunner pkgs.%s ];
+}
+""" % (
+        app_runner_nix % {"package": package, "executable": executable},
         package,
-        executable,
         package,
     )
 
 
-def generate_managed_nix(package: str, pubkey: str):
-    uid = os.getuid()
-    return base_nix % (uid, pubkey, pubkey, package)
+def generate_added_nix(packages: list[str]) -> str:
+    """Packages added to a running VM, linked to /run/vixos/added."""
+    return """let
+  pkgs = import <nixpkgs> {};
+in pkgs.buildEnv {
+  name = "vixos-added";
+  paths = [ %s ];
+  ignoreCollisions = true;
+}
+""" % " ".join(
+        f"pkgs.{package}" for package in packages
+    )
 
 
-base_nix = """{pkgs, ...}:
+def generate_base_default_nix() -> str:
+    return """{pkgs, ...}:
 {
+  imports = [
+    <nixpkgs/nixos/modules/virtualisation/qemu-vm.nix>
+    ./managed.nix
+    ../../global.nix
+  ];
+
+  environment.systemPackages = [ pkgs.waypipe ];
+
+  services.xserver.displayManager.sessionCommands = "${pkgs.bash}/bin/sh -c 'while [ ! -x /run/vixos/profile/bin/app ]; do sleep 0.05; done; exec /run/vixos/profile/bin/app' &";
+}
+"""
+
+
+def generate_managed_nix(
+    package: str,
+    pubkey: str,
+    shares: Optional[dict[str, Any]] = None,
+    fast_boot: bool = False,
+    overlay: bool = False,
+) -> str:
+    shares = shares if shares is not None else {"mode": "9p"}
+    if shares["mode"] == "virtiofs":
+        dax = bool(shares.get("dax_window"))
+        home_mount = "-t virtiofs home /home/user"
+        if dax:
+            home_mount = "-t virtiofs -o dax home /home/user"
+        store_options = '"ro" "dax"' if dax else '"ro"'
+        store_config = virtiofs_store_nix % {"options": store_options}
+    else:
+        home_mount = "-t 9p -o trans=virtio,version=9p2000.L home /home/user"
+        store_config = ""
+
+    return base_nix % {
+        "uid": os.getuid(),
+        "pubkey": pubkey,
+        "package": package,
+        "home_mount": home_mount,
+        "store_config": store_config,
+        "modules": (fast_boot_nix if fast_boot else "")
+        + (overlay_nix if overlay else ""),
+        "agent": nix_indented_string(
+            (Path(__file__).parent / "guest_agent.py").read_text()
+        ),
+    }
+
+
+# Fast boot profile: no serial console, xmonad compiled at build time,
+# a minimal initrd, and non-critical units out of the boot path. It is a
+# separate module: options set by base_nix can't be defined twice in the
+# same attribute set, across modules they are merged (or forced).
+fast_boot_nix = """
+    ({lib, config, ...}: {
+      systemd.services."serial-getty@ttyS0".enable = lib.mkForce false;
+
+      # NixOS compiles services.xserver.windowManager.xmonad.config when building.
+      services.xserver.windowManager.xmonad.config = config.environment.etc."xmonad.hs".text;
+      systemd.services.home-user-build-xmonad.enable = lib.mkForce false;
+
+      boot.initrd.includeDefaultModules = false;
+      boot.initrd.availableKernelModules = [ "virtio_pci" "virtio_blk" "virtio_console" "9p" "9pnet_virtio" "virtiofs" ];
+
+      networking.dhcpcd.wait = "background";
+      services.timesyncd.enable = false;
+      documentation.enable = false;
+      systemd.user.timers."xrandr".timerConfig.OnBootSec = lib.mkForce "3s";
+    })
+"""
+
+
+# Shared base system: the per-app profile (a store path, visible through the
+# /nix/store share) and the hostname are passed on the kernel command line.
+# Imported as a module, its environment.extraInit is merged with the one of
+# base_nix.
+overlay_nix = """
+    {
+      systemd.services.vixos-overlay = {
+        description = "Link the vixos app profile";
+        wantedBy = [ "sysinit.target" ];
+        after = [ "systemd-tmpfiles-setup.service" ];
+        before = [ "network-pre.target" "display-manager.service" ];
+        wants = [ "network-pre.target" ];
+        unitConfig.DefaultDependencies = false;
+        serviceConfig = {
+          Type = "oneshot";
+          RemainAfterExit = true;
+        };
+        script = ''
+          for arg in $(cat /proc/cmdline); do
+            case $arg in
+              vixos.profile=*) ln -sfn ''${arg#vixos.profile=} /run/vixos/profile ;;
+              vixos.hostname=*) echo ''${arg#vixos.hostname=} > /proc/sys/kernel/hostname ;;
+            esac
+          done
+        '';
+      };
+
+      environment.extraInit = ''
+        export PATH=/run/vixos/profile/bin:$PATH
+        export XDG_DATA_DIRS=/run/vixos/profile/share:$XDG_DATA_DIRS
+      '';
+    }
+"""
+
+
+# Replaces the 9p /nix/store mount of qemu-vm.nix.
+virtiofs_store_nix = """
+  boot.initrd.availableKernelModules = [ "virtiofs" ];
+  fileSystems."/nix/.ro-store" = lib.mkForce {
+    device = "nix-store";
+    fsType = "virtiofs";
+    options = [ %(options)s ];
+    neededForBoot = true;
+  };
+"""
+
+
+base_nix = """{pkgs, lib, config, ...}:
+{
+  imports = [%(modules)s  ];
+%(store_config)s
   systemd.services.home-user-build-xmonad = {
     description = "Link xmonad configuration";
     serviceConfig = {
@@ -87,7 +248,7 @@ base_nix = """{pkgs, ...}:
   # TODO: this is temporary, for development and debugging.
   users.users.root = { initialPassword = "root"; };
   users.extraUsers.user = {
-    uid = %s;
+    uid = %(uid)s;
     isNormalUser = true;
     extraGroups = [ "audio" ];
     createHome = true;
@@ -110,7 +271,7 @@ startup = do
   systemd.services.mount-home-user = {
     description = "Mount /home/user (crutch)";
     serviceConfig = {
-      ExecStart = "/bin/sh -c '/run/current-system/sw/bin/mount -t 9p -o trans=virtio,version=9p2000.L home /home/user'";
+      ExecStart = "/bin/sh -c '/run/current-system/sw/bin/mount %(home_mount)s'";
       RemainAfterExit = "yes";
       Type = "oneshot";
       User = "root";
@@ -118,6 +279,55 @@ startup = do
     wantedBy = [ "sysinit.target" ];
   };
 
+  # Arguments injected into VMs claimed from the warm pool.
+  systemd.tmpfiles.rules = [ "d /run/vixos 0755 user users -" ];
+
+  # Packages added at runtime by `vixos add`.
+  environment.extraInit = ''
+    export PATH=$PATH:/run/vixos/added/bin
+  '';
+
+  # Report boot phases to the host over virtio-serial (vixos/readiness.py).
+  # Only one process may open the port, so a single unit sends every phase.
+  systemd.services.vixos-ready = {
+    description = "Report boot phases to vixos";
+    wantedBy = [ "multi-user.target" ];
+    path = [ pkgs.iproute2 pkgs.gawk ];
+    script = ''
+      PORT=/dev/virtio-ports/org.vixos.ready
+      while [ ! -e $PORT ]; do sleep 0.05; done
+      exec 3> $PORT
+
+      ADDR=""
+      while [ -z "$ADDR" ]; do
+        ADDR=$(ip -4 -o addr show scope global | awk '{ split($4, a, "/"); print a[1]; exit }')
+        [ -z "$ADDR" ] && sleep 0.05
+      done
+      echo "ip $ADDR" >&3
+
+      while ! ss -Hltn 'sport = :22' | grep -q .; do sleep 0.05; done
+      echo "sshd" >&3
+
+      while [ ! -e /run/vixos/app-started ]; do sleep 0.05; done
+      echo "app" >&3
+    '';
+    serviceConfig.Type = "simple";
+  };
+
+  # Control channel for the host over virtio-vsock (vixos/guest_agent.py),
+  # requests are signed with the vixos key.
+  boot.kernelModules = [ "vmw_vsock_virtio_transport" ];
+  environment.etc."vixos/agent.pub".text = "%(pubkey)s";
+  systemd.services.vixos-agent = {
+    description = "vixos guest agent";
+    wantedBy = [ "multi-user.target" ];
+    path = [ pkgs.bash pkgs.util-linux ];
+    serviceConfig = {
+      ExecStart = "${pkgs.python3}/bin/python3 ${pkgs.writeText "vixos-agent.py" %(agent)s}";
+      Restart = "always";
+    };
+  };
+
   services.getty.autologinUser = "user";
 
   systemd.services."serial-getty@ttyS0" = {
@@ -147,14 +357,14 @@ startup = do
   # TODO: this is currently hilariously insecure, VMs can login to others.
   users.extraUsers.user = {
       openssh.authorizedKeys.keys = [
-        "%s"
+        "%(pubkey)s"
       ];
   };
   users.users.root = {
       openssh.authorizedKeys.keys = [
-        "%s"
+        "%(pubkey)s"
       ];
   };
 
-  networking.hostName = "%s";
+  networking.hostName = "%(package)s";
 }"""
@@ -1,4 +1,6 @@
 from pathlib import Path
+from typing import Any, Optional
+from xml.sax.saxutils import escape
 
 # Shamelessly stolen from https://github.com/jollheef/appvm/blob/master/xml.go
 # To be updated in future versions
@@ -13,8 +15,18 @@ def generate_xml(
     reginfo: str,
     image_path: Path,
     shared_path: Path,
+    console_log: Path,
+    extra_cmdline: str = "",
+    vcpus: int = 4,
+    tuning: str = "",
+    hugepages: bool = False,
+    shares: Optional[dict[str, Any]] = None,
+    fast_boot: bool = False,
+    memory: int = 8192,
+    dedup: bool = False,
 ) -> str:
     devices = gui_devices if gui else ""
+    shares = shares if shares is not None else {"mode": "9p"}
 
     return xml_template.format(
         vm_name=vm_name,
@@ -22,10 +34,128 @@ def generate_xml(
         reginfo=reginfo,
         image_path=image_path,
         shared_path=shared_path,
+        console_log=console_log,
         extra_devices=devices,
+        extra_cmdline=extra_cmdline,
+        vcpus=vcpus,
+        tuning=tuning,
+        memory_backing=generate_memory_backing_xml(hugepages, dedup),
+        nix_store_share=generate_share_xml("/nix/store", "nix-store", shares, True),
+        home_share=generate_share_xml(str(shared_path), "home", shares, False),
+        qemu_overrides=generate_share_overrides(["nix-store", "home"], shares),
+        console="quiet" if fast_boot else "console=ttyS0",
+        # memory and current_memory are in MiB, guests start with 1 GiB.
+        memory=memory,
+        current_memory=min(memory, 1024),
     )
 
 
+def generate_memory_backing_xml(hugepages: bool, dedup: bool) -> str:
+    """Shared memfd backing (needed by virtiofs), or mergeable memory.
+
+    KSM only merges private anonymous memory, so dedup domains use that
+    (with 9p shares) and all others opt out of KSM scanning.
+    """
+    if dedup:
+        return ""
+    lines = ["<hugepages/>"] if hugepages else []
+    lines += ["<source type='memfd'/>", "<access mode='shared'/>", "<nosharepages/>"]
+    inner = "".join(f"\n    {line}" for line in lines)
+    return f"<memoryBacking>{inner}\n  </memoryBacking>"
+
+
+def generate_share_xml(
+    source: str, tag: str, shares: dict[str, Any], readonly: bool
+) -> str:
+    if shares["mode"] == "9p":
+        return share_9p_template.format(
+            source_dir=source,
+            mount_tag=tag,
+            readonly="<readonly/>" if readonly else "",
+        )
+    # No <readonly/> for virtiofs, libvirt rejects it. managed.nix mounts
+    # the store read-only.
+    return share_virtiofs_template.format(
+        source_dir=source,
+        mount_tag=tag,
+        cache=generate_cache_xml(shares["cache"]),
+        thread_pool=shares["thread_pool"],
+    )
+
+
+def generate_cache_xml(cache: str) -> str:
+    # libvirt only accepts "none" and "always", without the element
+    # virtiofsd uses its own default, "auto".
+    if cache == "auto":
+        return ""
+    return f"<cache mode='{cache}'/>"
+
+
+def generate_share_overrides(tags: list[str], shares: dict[str, Any]) -> str:
+    """DAX windows are not modelled by libvirt, set them as device properties.
+
+    cache-size only exists in QEMU builds with the out-of-tree virtio-fs
+    DAX patches, upstream QEMU rejects the domain with it.
+    """
+    if shares["mode"] != "virtiofs" or not shares["dax_window"]:
+        return ""
+    cache_size = shares["dax_window"] * 1024 * 1024
+    devices = "".join(
+        share_dax_template.format(mount_tag=tag, cache_size=cache_size)
+        for tag in tags
+    )
+    return f"<qemu:override>{devices}\n  </qemu:override>"
+
+
+share_9p_template = """
+    <filesystem type='mount' accessmode='passthrough'>
+      <source dir='{source_dir}'/>
+      <target dir='{mount_tag}'/>
+      {readonly}
+    </filesystem>"""
+
+share_virtiofs_template = """
+    <filesystem type='mount' accessmode='passthrough'>
+      <driver type='virtiofs' queue='1024'/>
+      <binary path='/run/current-system/sw/bin/virtiofsd' xattr='on'>
+        {cache}
+        <thread_pool size='{thread_pool}'/>
+      </binary>
+      <source dir='{source_dir}'/>
+      <target dir='{mount_tag}'/>
+      <alias name='ua-{mount_tag}'/>
+    </filesystem>"""
+
+share_dax_template = """
+    <qemu:device alias='ua-{mount_tag}'>
+      <qemu:frontend>
+        <qemu:property name='cache-size' type='unsigned' value='{cache_size}'/>
+      </qemu:frontend>
+    </qemu:device>"""
+
+
+def generate_tuning_xml(
+    vcpu_pins: list[str],
+    emulator_pin: Optional[str],
+    nodeset: Optional[str],
+    strict: bool = False,
+) -> str:
+    lines = []
+    if vcpu_pins or emulator_pin:
+        lines.append("<cputune>")
+        for vcpu, cpuset in enumerate(vcpu_pins):
+            lines.append(f"  <vcpupin vcpu='{vcpu}' cpuset='{cpuset}'/>")
+        if emulator_pin:
+            lines.append(f"  <emulatorpin cpuset='{emulator_pin}'/>")
+        lines.append("</cputune>")
+    if nodeset is not None:
+        lines.append("<numatune>")
+        mode = "strict" if strict else "preferred"
+        lines.append(f"  <memory mode='{mode}' nodeset='{nodeset}'/>")
+        lines.append("</numatune>")
+    return "\n  ".join(lines)
+
+
 gui_devices = """
     <!-- Graphical console -->
     <graphics type='spice' autoport='yes'>
@@ -44,15 +174,16 @@ gui_devices = """
 xml_template = """
 <domain type='kvm' xmlns:qemu='http://libvirt.org/schemas/domain/qemu/1.0'>
   <name>{vm_name}</name>
-  <memory unit='GiB'>8</memory>
-  <currentMemory unit='GiB'>1</currentMemory>
-  <vcpu>4</vcpu>
+  <memory unit='MiB'>{memory}</memory>
+  <currentMemory unit='MiB'>{current_memory}</currentMemory>
+  <vcpu>{vcpus}</vcpu>
+  {tuning}
   <os>
     <type arch='x86_64'>hvm</type>
     <kernel>{vm_path}/kernel</kernel>
     <initrd>{vm_path}/initrd</initrd>
-    <!-- TODO remove console=ttyS0 by default to speed up boot times -->
-    <cmdline>loglevel=4 init={vm_path}/init console=ttyS0 {reginfo}</cmdline>
+    <!-- console=ttyS0 is dropped by the fast boot profile -->
+    <cmdline>loglevel=4 init={vm_path}/init {console} {reginfo} {extra_cmdline}</cmdline>
   </os>
   <features>
     <acpi></acpi>
@@ -61,10 +192,7 @@ xml_template = """
   <on_poweroff>destroy</on_poweroff>
   <on_reboot>restart</on_reboot>
   <on_crash>destroy</on_crash>
-  <memoryBacking>
-    <source type='memfd'/>
-    <access mode='shared'/>
-  </memoryBacking>
+  {memory_backing}
   <devices>
     <!-- Fake (because -snapshot) writeback image -->
     <disk type='file' device='disk'>
@@ -75,6 +203,8 @@ xml_template = """
     </disk>
     <serial type='pty'>
       <source path='/dev/pts/0'/>
+      <!-- Guest boot log, for boot time analysis -->
+      <log file='{console_log}' append='off'/>
       <target type='isa-serial' port='0'>
         <model name='isa-serial'/>
       </target>
@@ -86,11 +216,9 @@ xml_template = """
       <alias name='serial0'/>
     </console>
     <!-- filesystems -->
-    <filesystem type='mount' accessmode='passthrough'>
-      <source dir='/nix/store'/>
-      <target dir='nix-store'/> <!-- handled by nixpkgs/nixos/modules/virtualisation/qemu-vm.nix -->
-      <readonly/>
-    </filesystem>
+    <!-- nix-store is mounted by nixpkgs/nixos/modules/virtualisation/qemu-vm.nix
+         (or by managed.nix, for virtiofs) -->
+    {nix_store_share}
     <filesystem type='mount' accessmode='mapped'>
       <source dir='{shared_path}'/>
       <target dir='xchg'/> <!-- workaround for nixpkgs/nixos/modules/virtualisation/qemu-vm.nix -->
@@ -99,15 +227,25 @@ xml_template = """
       <source dir='{shared_path}'/>
       <target dir='shared'/> <!-- workaround for nixpkgs/nixos/modules/virtualisation/qemu-vm.nix -->
     </filesystem>
-    <filesystem type='mount' accessmode='passthrough'>
-      <source dir='{shared_path}'/>
-      <target dir='home'/>
-    </filesystem>
+    {home_share}
+    <!-- Memory balloon, resized at runtime by vixos/balloon.py -->
+    <memballoon model='virtio'>
+      <stats period='2'/>
+    </memballoon>
+    <!-- Boot phase notifications, see vixos/readiness.py -->
+    <channel type='unix'>
+      <target type='virtio' name='org.vixos.ready'/>
+    </channel>
     <interface type='network'>
       <source network='default'/>
     </interface>
+    <!-- Host <-> guest sockets without the network, see vixos/waypipe.py -->
+    <vsock model='virtio'>
+      <cid auto='yes'/>
+    </vsock>
     {extra_devices}
   </devices>
+  {qemu_overrides}
 </domain>
 """
 
@@ -115,18 +253,33 @@ xml_template = """
 def generate_mount_xml(
     source: str,
     tag: str,
+    cache: str = "auto",
+    thread_pool: int = 16,
+    xattr: bool = True,
+    queue: int = 1024,
 ) -> str:
+    # libvirt rejects <readonly/> for virtiofs ("virtiofs does not yet
+    # support read-only mode"), read-only mounts use -o ro in the guest
+    # instead (see AppVM.mount).
     return mount_xml_template.format(
-        source_dir=source,
+        source_dir=escape(source, {"'": "&apos;"}),
         mount_tag=tag,
+        cache=generate_cache_xml(cache),
+        thread_pool=thread_pool,
+        xattr="on" if xattr else "off",
+        queue=queue,
     )
 
 
 mount_xml_template = """
 <filesystem type='mount' accessmode='passthrough'>
-  <binary path='/run/current-system/sw/bin/virtiofsd' xattr='on' />
-  <driver type='virtiofs' queue='1024'/>
+  <driver type='virtiofs' queue='{queue}'/>
+  <binary path='/run/current-system/sw/bin/virtiofsd' xattr='{xattr}'>
+    {cache}
+    <thread_pool size='{thread_pool}'/>
+  </binary>
   <source dir='{source_dir}'/>
   <target dir='{mount_tag}'/>
+  <alias name='ua-{mount_tag}'/>
 </filesystem>
 """
@@ -0,0 +1,59 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+
+class Tracer:
+    """Records monotonic timestamps of launch phases.
+
+    Phases have a start and an end, marks are single points in time (for
+    example boot phases reported by the guest). All times are stored in
+    seconds relative to the creation of the tracer.
+    """
+
+    def __init__(self) -> None:
+        self.origin = time.monotonic()
+        self.wall_origin = time.time()
+        self.events: list[dict[str, Any]] = []
+        self.lock = threading.Lock()
+
+    def relative(self, timestamp: float) -> float:
+        return timestamp - self.origin
+
+    @contextmanager
+    def phase(self, name: str, **attrs: Any) -> Iterator[dict[str, Any]]:
+        event = {"name": name, "start": self.relative(time.monotonic()), **attrs}
+        try:
+            yield event
+        finally:
+            event["end"] = self.relative(time.monotonic())
+            with self.lock:
+                self.events.append(event)
+
+    def mark(self, name: str, at: Optional[float] = None, **attrs: Any) -> None:
+        timestamp = self.relative(at if at is not None else time.monotonic())
+        with self.lock:
+            self.events.append({"name": name, "start": timestamp, **attrs})
+
+    def to_json(self) -> dict[str, Any]:
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event["start"])
+        return {"started_at": self.wall_origin, "events": events}
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        path.write_text(json.dumps(self.to_json(), indent=2))
+
+    def report(self) -> str:
+        lines = []
+        for event in self.to_json()["events"]:
+            start = event["start"] * 1000
+            if "end" in event:
+                duration = (event["end"] - event["start"]) * 1000
+                lines.append(f"{start:10.1f}ms  {event['name']:<24} {duration:10.1f}ms")
+            else:
+                lines.append(f"{start:10.1f}ms  {event['name']:<24} {'(mark)':>12}")
+        return "\n".join(lines)
@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+import os
+import posixpath
+import queue
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Any, Optional, Union
+
+from .agent import AgentClient
+from .lazy import lazy_import
+from .ssh import SshManager
+
+paramiko = lazy_import("paramiko")
+
+# Read/write block size. Remote reads are prefetched, so many requests for
+# these blocks are in flight at once.
+CHUNK_SIZE = 1024 * 1024
+
+# Blocks buffered in memory between the two legs of a VM to VM copy.
+STREAM_BUFFER_CHUNKS = 8
+
+
+class LocalEndpoint:
+    """Host filesystem side of a transfer."""
+
+    name = "localhost"
+
+    def stat(self, path: str) -> Optional[os.stat_result]:
+        try:
+            return os.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def listdir(self, path: str) -> list[str]:
+        return os.listdir(path)
+
+    def makedirs(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+
+    def open_read(self, path: str, offset: int) -> IO[bytes]:
+        f = open(path, "rb")
+        f.seek(offset)
+        return f
+
+    def open_write(self, path: str, append: bool) -> IO[bytes]:
+        return open(path, "ab" if append else "wb")
+
+    def join(self, *parts: str) -> str:
+        return os.path.join(*parts)
+
+    def basename(self, path: str) -> str:
+        return os.path.basename(os.path.normpath(path))
+
+
+class RemoteEndpoint:
+    """VM side of a transfer. Every worker thread gets its own SFTP channel."""
+
+    def __init__(
+        self, ssh: SshManager, name: str, user: str, host: str, compress: bool
+    ) -> None:
+        self.name = name
+        self.client = ssh.ssh_session(user, host, compress)
+        self.local = threading.local()
+
+    @property
+    def sftp(self) -> paramiko.SFTPClient:
+        if not hasattr(self.local, "sftp"):
+            self.local.sftp = self.client.open_sftp()
+        return self.local.sftp
+
+    def stat(self, path: str) -> Optional[Any]:
+        try:
+            return self.sftp.stat(path)
+        except FileNotFoundError:
+            return None
+
+    def listdir(self, path: str) -> list[str]:
+        return self.sftp.listdir(path)
+
+    def makedirs(self, path: str) -> None:
+        current = "/" if path.startswith("/") else ""
+        for part in path.split("/"):
+            if not part:
+                continue
+            current = posixpath.join(current, part)
+            if self.stat(current) is None:
+                self.sftp.mkdir(current)
+
+    def open_read(self, path: str, offset: int) -> IO[bytes]:
+        f = self.sftp.open(path, "rb")
+        f.seek(offset)
+        # Requests all remaining blocks from the current offset in parallel.
+        f.prefetch()
+        return f
+
+    def open_write(self, path: str, append: bool) -> IO[bytes]:
+        f = self.sftp.open(path, "ab" if append else "wb")
+        # Don't wait for a server response after every write.
+        f.set_pipelined(True)
+        return f
+
+    def join(self, *parts: str) -> str:
+        return posixpath.join(*parts)
+
+    def basename(self, path: str) -> str:
+        return posixpath.basename(posixpath.normpath(path))
+
+
+class AgentEndpoint:
+    """VM side of a transfer through the guest agent, over virtio-vsock."""
+
+    def __init__(self, agent: AgentClient, name: str, user: str) -> None:
+        self.name = name
+        self.agent = agent
+        self.user = user
+
+    def stat(self, path: str) -> Optional[Any]:
+        return self.agent.stat(path, self.user)
+
+    def listdir(self, path: str) -> list[str]:
+        return self.agent.listdir(path, self.user)
+
+    def makedirs(self, path: str) -> None:
+        self.agent.makedirs(path, self.user)
+
+    def open_read(self, path: str, offset: int) -> IO[bytes]:
+        return self.agent.open_read(path, offset, self.user)
+
+    def open_write(self, path: str, append: bool) -> IO[bytes]:
+        return self.agent.open_write(path, append, self.user)
+
+    def join(self, *parts: str) -> str:
+        return posixpath.join(*parts)
+
+    def basename(self, path: str) -> str:
+        return posixpath.basename(posixpath.normpath(path))
+
+
+Endpoint = Union[LocalEndpoint, RemoteEndpoint, AgentEndpoint]
+
+
+def is_dir(st: Optional[Any]) -> bool:
+    return st is not None and stat.S_ISDIR(st.st_mode)
+
+
+class TransferStats:
+    def __init__(self) -> None:
+        self.files = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.end = self.start
+        self.lock = threading.Lock()
+
+    def add(self, nbytes: int) -> None:
+        with self.lock:
+            self.bytes += nbytes
+
+    def finish_file(self, skipped: bool = False) -> None:
+        with self.lock:
+            if skipped:
+                self.skipped += 1
+            else:
+                self.files += 1
+            self.end = time.monotonic()
+
+    @property
+    def seconds(self) -> float:
+        return max(self.end - self.start, 1e-9)
+
+    def summary(self) -> str:
+        mib = self.bytes / (1024 * 1024)
+        return (
+            f"{self.files} files ({self.skipped} up to date), {mib:.1f} MiB "
+            f"in {self.seconds:.2f}s, {mib / self.seconds:.1f} MiB/s"
+        )
+
+
+class TransferEngine:
+    """Copies files and directory trees between hosts and VMs.
+
+    Files are copied concurrently (one SFTP channel per worker), large files
+    use pipelined reads and writes, and `resume` appends to partially
+    transferred destination files instead of starting over.
+    """
+
+    def __init__(self, jobs: int = 4, resume: bool = False) -> None:
+        self.jobs = jobs
+        self.resume = resume
+
+    def plan(
+        self, src: Endpoint, src_path: str, dst: Endpoint, dst_path: str
+    ) -> list[tuple[str, str, int]]:
+        """Create destination directories and return (src, dst, size) files."""
+        src_stat = src.stat(src_path)
+        if src_stat is None:
+            raise FileNotFoundError(f"{src.name}:{src_path} does not exist")
+        if is_dir(dst.stat(dst_path)):
+            dst_path = dst.join(dst_path, src.basename(src_path))
+
+        if not is_dir(src_stat):
+            return [(src_path, dst_path, src_stat.st_size)]
+
+        files = []
+        pending = [(src_path, dst_path)]
+        while pending:
+            src_dir, dst_dir = pending.pop()
+            dst.makedirs(dst_dir)
+            for name in src.listdir(src_dir):
+                src_child = src.join(src_dir, name)
+                dst_child = dst.join(dst_dir, name)
+                child_stat = src.stat(src_child)
+                if is_dir(child_stat):
+                    pending.append((src_child, dst_child))
+                elif child_stat is not None:
+                    files.append((src_child, dst_child, child_stat.st_size))
+        return files
+
+    def copy_file(
+        self,
+        src: Endpoint,
+        src_path: str,
+        dst: Endpoint,
+        dst_path: str,
+        size: int,
+        stats: TransferStats,
+    ) -> None:
+        offset = 0
+        if self.resume:
+            dst_stat = dst.stat(dst_path)
+            if dst_stat is not None and dst_stat.st_size <= size:
+                offset = dst_stat.st_size
+        if offset == size and offset > 0:
+            stats.finish_file(skipped=True)
+            return
+
+        with src.open_read(src_path, offset) as reader:
+            with dst.open_write(dst_path, offset > 0) as writer:
+                if not isinstance(src, LocalEndpoint) and not isinstance(dst, LocalEndpoint):
+                    self.stream(reader, writer, stats)
+                else:
+                    while True:
+                        chunk = reader.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        writer.write(chunk)
+                        stats.add(len(chunk))
+        stats.finish_file()
+
+    def stream(self, reader: IO[bytes], writer: IO[bytes], stats: TransferStats) -> None:
+        """Read and write concurrently through a bounded in-memory buffer.
+
+        Used when both sides are VMs (over SFTP or the guest agent), so the
+        two legs overlap and nothing is staged on the host disk.
+        """
+        buffer: queue.Queue[Optional[bytes]] = queue.Queue(STREAM_BUFFER_CHUNKS)
+        errors: list[BaseException] = []
+
+        def read_all() -> None:
+            try:
+                while not errors:
+                    chunk = reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    buffer.put(chunk)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                buffer.put(None)
+
+        thread = threading.Thread(target=read_all, daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = buffer.get()
+                if chunk is None:
+                    break
+                writer.write(chunk)
+                stats.add(len(chunk))
+        except BaseException as e:
+            errors.append(e)
+            # Unblock the reader if it waits for free buffer space.
+            while thread.is_alive():
+                try:
+                    buffer.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def copy(
+        self, src: Endpoint, src_path: str, destinations: list[tuple[Endpoint, str]]
+    ) -> TransferStats:
+        """Copy src_path to every destination (fan-out) and return statistics."""
+        stats = TransferStats()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = []
+            for dst, dst_path in destinations:
+                for src_file, dst_file, size in self.plan(src, src_path, dst, dst_path):
+                    futures.append(
+                        executor.submit(
+                            self.copy_file, src, src_file, dst, dst_file, size, stats
+                        )
+                    )
+            for future in futures:
+                future.result()
+        return stats
@@ -0,0 +1,142 @@
+import json
+import os
+import signal
+import subprocess
+from pathlib import Path
+from typing import Any, Optional
+
+# The host as seen from the guest over virtio-vsock.
+VSOCK_HOST_CID = 2
+
+# Every VM gets its own host port, the base plus its guest CID.
+VSOCK_BASE_PORT = 20000
+
+TRANSPORTS = ("vsock", "ssh")
+
+
+class WaypipeOptions:
+    """Transport and tuning of waypipe GUI forwarding.
+
+    compress is passed to waypipe --compress ("none", "lz4", "zstd" or
+    "zstd=N"), threads to --threads (0 lets waypipe choose) and video, if
+    set, to the server as --video=... (for example "hw" or "sw,h264").
+    """
+
+    def __init__(
+        self,
+        transport: str = "vsock",
+        compress: str = "lz4",
+        threads: int = 0,
+        video: Optional[str] = None,
+    ) -> None:
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown waypipe transport: {transport}")
+        self.transport = transport
+        self.compress = compress
+        self.threads = threads
+        self.video = video
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "transport": self.transport,
+            "compress": self.compress,
+            "threads": self.threads,
+            "video": self.video,
+        }
+
+    def flags(self) -> list[str]:
+        flags = ["--compress", self.compress, "--threads", str(self.threads)]
+        if self.transport == "vsock":
+            flags.append("--vsock")
+        return flags
+
+
+class WaypipeClient:
+    """A long-lived `waypipe client` per VM, shared by all waypipe-exec calls.
+
+    The client is restarted only when the options or the guest CID change.
+    With the ssh transport it listens on a unix socket that every command
+    forwards with `ssh -R`, with vsock the guest connects to it directly.
+    """
+
+    def __init__(
+        self, vixos_path: Path, options: WaypipeOptions, cid: Optional[int] = None
+    ) -> None:
+        self.vixos_path = vixos_path
+        self.options = options
+        self.cid = cid
+        self.state_path = vixos_path / "waypipe.json"
+        self.socket_path = vixos_path / "waypipe.sock"
+
+    @property
+    def port(self) -> int:
+        assert self.cid is not None
+        return VSOCK_BASE_PORT + self.cid
+
+    def wanted_state(self) -> dict[str, Any]:
+        return {"options": self.options.to_json(), "cid": self.cid}
+
+    def load_state(self) -> Optional[dict[str, Any]]:
+        if not self.state_path.exists():
+            return None
+        return json.loads(self.state_path.read_text())
+
+    @staticmethod
+    def alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def running(self) -> bool:
+        state = self.load_state()
+        if state is None or not self.alive(state["pid"]):
+            return False
+        return {k: state[k] for k in ("options", "cid")} == self.wanted_state()
+
+    def ensure(self) -> None:
+        if self.running():
+            return
+        self.stop()
+        if self.options.transport == "vsock":
+            address = str(self.port)
+        else:
+            address = str(self.socket_path)
+            self.socket_path.unlink(missing_ok=True)
+        process = subprocess.Popen(
+            ["waypipe", *self.options.flags(), "--socket", address, "client"],
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        state = dict(self.wanted_state(), pid=process.pid)
+        self.state_path.write_text(json.dumps(state))
+
+    def stop(self) -> None:
+        state = self.load_state()
+        if state is not None and self.alive(state["pid"]):
+            os.killpg(state["pid"], signal.SIGTERM)
+        self.state_path.unlink(missing_ok=True)
+
+    def server_command(self, command: str, remote_socket: str) -> str:
+        flags = self.options.flags()
+        if self.options.video:
+            flags.append(f"--video={self.options.video}")
+        if self.options.transport == "vsock":
+            address = f"{VSOCK_HOST_CID}:{self.port}"
+        else:
+            address = remote_socket
+        return f"waypipe {' '.join(flags)} --socket {address} server -- {command}"
+
+    def ssh_command(self, command: str) -> list[str]:
+        """ssh flags and remote command for one forwarded application."""
+        if self.options.transport == "vsock":
+            return [self.server_command(command, "")]
+        remote_socket = f"/tmp/waypipe-{os.urandom(6).hex()}.sock"
+        return [
+            "-o",
+            "StreamLocalBindUnlink=yes",
+            "-R",
+            f"{remote_socket}:{self.socket_path}",
+            self.server_command(command, remote_socket),
+        ]